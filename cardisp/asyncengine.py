@@ -0,0 +1,141 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Single event loop alternative to the reader, writer and keyboard threads
+
+CAN receive goes through a python-can Notifier into an AsyncBufferedReader (on socketcan the
+Notifier registers the socket with the loop, so no extra thread), and batches are fed to the
+same CanReader.processbatch() the threaded reader uses. OBD requests go out from one schedule
+on the same loop, and evdev input comes from InputDevice.async_read_loop().
+"""
+import asyncio
+import logging
+import time
+from threading import Thread, Event
+
+import can
+from evdev import InputDevice
+
+from canwriter import sendpids, OBDScheduler
+
+
+class AsyncEngine(Thread):
+    """Run CAN ingest, OBD polling and input for hs_scan on one asyncio loop in one thread
+
+    reader - a CanReader that is not started; its bus, batching settings and data store are used.
+             None to run only the input side (e.g. when ingest runs in another process).
+    pids - OBDPid requests to send from an OBDScheduler on the reader's bus (see scheduler).
+    events - queue the input events are put on, None to not read input.
+    inputdevice - evdev device path, reopened every 0.1s until it appears.
+    """
+
+    def __init__(self, reader=None, pids=sendpids, events=None, inputdevice='/dev/input/event1',
+                 isrunning=Event()):
+        super(AsyncEngine, self).__init__(name='AsyncEngine')
+        self.reader = reader
+        self.scheduler = OBDScheduler(pids=pids, bus=reader.can_bus) if reader is not None and pids else None
+        if self.scheduler is not None:
+            reader.responsehandler = self.scheduler.onresponse
+        self.events = events
+        self.inputdevice = inputdevice
+        self.isrunning = isrunning
+
+    async def ingest(self):
+        reader = self.reader
+        buffered = can.AsyncBufferedReader()
+        notifier = can.Notifier(reader.can_bus, [buffered], timeout=reader.recvtimeout,
+                                loop=asyncio.get_running_loop())
+
+        try:
+            while True:
+                # With unpublished samples, only wait as long as the snapshot may lag
+                timeout = reader.snapshotperiod if reader._dirty else reader.recvtimeout
+                try:
+                    message = await asyncio.wait_for(buffered.get_message(), timeout)
+                except asyncio.TimeoutError:
+                    if reader._dirty:
+                        reader.publish()
+                    continue
+
+                batch = [message]
+                while len(batch) < reader.batchsize and not buffered.buffer.empty():
+                    batch.append(buffered.buffer.get_nowait())
+
+                reader.processbatch(batch)
+        finally:
+            notifier.stop()
+
+    async def obdschedule(self):
+        while True:
+            await asyncio.sleep(self.scheduler.step(time.monotonic()))
+
+    async def input(self):
+        while True:
+            try:
+                dev = InputDevice(self.inputdevice)
+            except OSError:
+                logging.info('Waiting for input device')
+                await asyncio.sleep(0.1)
+                continue
+
+            try:
+                dev.grab()
+                async for event in dev.async_read_loop():
+                    self.events.put(event)
+            except OSError:
+                logging.warning(f'Lost input device {self.inputdevice}')
+            finally:
+                try:
+                    dev.ungrab()
+                except OSError:
+                    pass
+                dev.close()
+
+    async def main(self):
+        tasks = []
+        if self.reader is not None:
+            tasks.append(asyncio.create_task(self.ingest()))
+        if self.scheduler is not None:
+            tasks.append(asyncio.create_task(self.obdschedule()))
+        if self.events is not None:
+            tasks.append(asyncio.create_task(self.input()))
+
+        while self.isrunning.is_set():
+            await asyncio.sleep(0.1)
+
+            for task in [task for task in tasks if task.done()]:
+                logging.error(f'{task.get_coro().__name__} stopped', exc_info=task.exception())
+                tasks.remove(task)
+
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+        if self.reader is not None:
+            self.reader.can_bus.shutdown()
+
+        logging.warning('Async engine stopped')
+
+    def run(self):
+        asyncio.run(self.main())
+
+
+if __name__ == '__main__':
+    from canreader import CanReader
+
+    isrunning = Event()
+    isrunning.set()
+
+    reader = CanReader(canbus='vcan0', dbc=['canbus_dbc/gm_global_a_hs.dbc', 'canbus_dbc/m22_obd.dbc'],
+                       isrunning=isrunning)
+    engine = AsyncEngine(reader, isrunning=isrunning)
+    engine.start()
+
+    while True:
+        try:
+            time.sleep(1)
+            print(reader.getstats())
+        except KeyboardInterrupt:
+            break
+
+    isrunning.clear()
+    engine.join()
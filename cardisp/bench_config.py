@@ -0,0 +1,41 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Import time and memory of config.py, and the cost of showing each gauge screen the first time
+
+Run from the repo root: python3 cardisp/bench_config.py
+"""
+import resource
+import time
+
+# Libraries first, so only what config itself does is measured
+import numpy  # noqa: F401
+import pygame  # noqa: F401
+from PIL import Image, ImageDraw, ImageFont  # noqa: F401
+
+
+def rss():
+    """Peak resident set size in MB (Linux reports ru_maxrss in kB)"""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+if __name__ == '__main__':
+    before = rss()
+    started = time.perf_counter()
+    import config as gcfg
+    import resources
+    imported = time.perf_counter() - started
+
+    gauges = [gaugedef.gaugeclass for screen in gcfg.screens + [gcfg.perfgauges, gcfg.meatballguages]
+              for gaugedef in screen]
+
+    print(f'import config: {imported * 1000:.1f}ms, +{rss() - before:.1f}MB, '
+          f'{len(gauges)} gauges, {len({id(g) for g in gauges})} distinct, {resources.stats()}')
+
+    for i, screen in enumerate(gcfg.screens):
+        started = time.perf_counter()
+        for gaugedef in screen:
+            gaugedef.gaugeclass.drawval(None)
+
+        print(f'screen {i} first frame: {(time.perf_counter() - started) * 1000:.1f}ms, {resources.stats()}')
+
+    print(f'peak RSS {rss():.1f}MB')
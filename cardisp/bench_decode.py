@@ -0,0 +1,65 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Frames/s per message, generated decoder vs cantools
+
+Run from the repo root: python3 cardisp/bench_decode.py [dbcfile] [frames]
+"""
+import sys
+import random
+import timeit
+
+import cantools
+
+from fastdecode import compiledecoder, FALLBACK_REASONS
+
+
+def payload(message, attempts=1000):
+    """A payload cantools can decode (multiplexed messages reject most random data)"""
+    rnd = random.Random(message.frame_id)
+    candidates = [bytes(rnd.getrandbits(8) for _ in range(message.length)) for _ in range(attempts)]
+
+    for data in [bytes(message.length)] + candidates:
+        try:
+            message.decode(data)
+            return data
+        except Exception:
+            continue
+
+    return None
+
+
+def bench(message, frames):
+    data = payload(message)
+    if data is None:
+        return None, None
+
+    cantoolsfps = frames / timeit.timeit(lambda: message.decode(data), number=frames)
+
+    decoder = compiledecoder(message)
+    if decoder is None:
+        return cantoolsfps, None
+
+    fastfps = frames / timeit.timeit(lambda: decoder(data), number=frames)
+
+    return cantoolsfps, fastfps
+
+
+if __name__ == '__main__':
+    dbcfile = sys.argv[1] if len(sys.argv) > 1 else 'canbus_dbc/gm_global_a_hs.dbc'
+    frames = int(sys.argv[2]) if len(sys.argv) > 2 else 20000
+
+    db = cantools.database.load_file(dbcfile)
+
+    print(f'{"arbid":>6} {"message":40} {"signals":>7} {"cantools f/s":>13} {"generated f/s":>14} {"speedup":>8}')
+
+    for message in sorted(db.messages, key=lambda m: m.frame_id):
+        cantoolsfps, fastfps = bench(message, frames)
+
+        if cantoolsfps is None:
+            print(f'{message.frame_id:#06x} {message.name:40} {len(message.signals):7} no decodable payload found')
+        elif fastfps is None:
+            print(f'{message.frame_id:#06x} {message.name:40} {len(message.signals):7} {cantoolsfps:13.0f} '
+                  f'{"cantools: " + FALLBACK_REASONS[message.frame_id]}')
+        else:
+            print(f'{message.frame_id:#06x} {message.name:40} {len(message.signals):7} {cantoolsfps:13.0f} '
+                  f'{fastfps:14.0f} {fastfps / cantoolsfps:7.1f}x')
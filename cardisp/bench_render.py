@@ -0,0 +1,59 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Per gauge render time of the config.screens gauges: full redraw, pre-rendered layers, and
+layers drawn in place into a TileBuffer (what hs_scan does)
+
+Run from the repo root: python3 cardisp/bench_render.py [frames]
+"""
+import sys
+import timeit
+
+from PIL import ImageChops
+
+import config as gcfg
+from imagegauge import ImageGauge
+from tilebuffer import TileBuffer
+
+
+def values(gaugeconfig, frames):
+    """Values sweeping min..max (and a None now and then), like a live signal"""
+    low, high = gaugeconfig.min, gaugeconfig.max
+    return [None if i % 50 == 49 else low + (high - low) * (i % 100) / 99 for i in range(frames)]
+
+
+def bench(gauge, frames):
+    samples = values(gauge.gaugeconfig, frames)
+    full = ImageGauge(gauge.gaugestyle, gauge.gaugeconfig, prerender=False)
+    layered = ImageGauge(gauge.gaugestyle, gauge.gaugeconfig, prerender=True)
+
+    identical = all(ImageChops.difference(full.drawval(v), layered.drawval(v)).getbbox() is None
+                    for v in samples[:100])
+
+    fulltime = timeit.timeit(lambda: [full.drawval(v) for v in samples], number=1) / frames
+    layeredtime = timeit.timeit(lambda: [layered.drawval(v) for v in samples], number=1) / frames
+
+    tile = TileBuffer((gauge.gaugestyle.width, gauge.gaugestyle.height))
+    tiletime = timeit.timeit(lambda: [layered.drawinto(v, tile.image) for v in samples], number=1) / frames
+
+    return fulltime, layeredtime, tiletime, identical
+
+
+if __name__ == '__main__':
+    frames = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+
+    print(f'{"screen":>6} {"gauge":36} {"full ms":>8} {"layered ms":>11} {"tile ms":>8} {"speedup":>8} identical')
+
+    totals = [0, 0, 0]
+    for i, screen in enumerate(gcfg.screens):
+        for gaugedef in screen:
+            fulltime, layeredtime, tiletime, identical = bench(gaugedef.gaugeclass, frames)
+            totals[0] += fulltime
+            totals[1] += layeredtime
+            totals[2] += tiletime
+
+            print(f'{i:6} {gaugedef.name:36} {fulltime * 1000:8.2f} {layeredtime * 1000:11.2f} '
+                  f'{tiletime * 1000:8.2f} {fulltime / tiletime:7.1f}x {identical}')
+
+    screens = len(gcfg.screens)
+    print(f'per screen of 8: {totals[0] * 1000 / screens:.1f}ms -> {totals[1] * 1000 / screens:.1f}ms'
+          f' -> {totals[2] * 1000 / screens:.1f}ms in place')
@@ -0,0 +1,10 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""When the display started booting
+
+Imported first by hs_scan, ahead of pygame, cantools, config and the rest, so
+boot times measured from start include loading them.
+"""
+import time
+
+start = time.monotonic()
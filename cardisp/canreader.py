@@ -1,96 +1,346 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 from threading import Thread, Event
-import datetime
-from collections import namedtuple, deque
+from collections import deque, Counter, namedtuple
+from functools import partial
 from pprint import pprint
 import logging
+import time
 
 import can
-import cantools
 
-CanSignal = namedtuple('CanSignal',
-                       ['name', 'minimum', 'maximum', 'unit', 'comment'])
+from fastdecode import compiledecoder
+from dbcache import loaddatabase, CanSignal  # noqa: F401
+from timeseries import TimeSeries, TieredHistory, HISTORYTIERS
+
+# Immutable view of the reader state published for the renderer, see CanReader.publish()
+ReaderSnapshot = namedtuple('ReaderSnapshot', ['version', 'timestamp', 'current', 'perf', 'accel'])
+PerfSnapshot = namedtuple('PerfSnapshot', ['state', 'curr_et', 'distance', 'current_result', 'last_result'])
+AccelSnapshot = namedtuple('AccelSnapshot', ['lat', 'accel', 'latminmax', 'accelminmax', 'history'])
+
+# OBD responders answer on 0x7E8-0x7EF
+OBDRESPONSEID = 0x7E8
+OBDRESPONSEMASK = 0x7F8
 
 
 class CanReader(Thread):
     """Read CANBUS data and store/process it for downstream display
 
     signals - dictionary of CanSignal objects read from the passed in DBCs
-    data - 100ms, 2 minute dict of deques for trending/graphing.
-    currentdata - dict of deque(2) for current and last sample.
+    data - dict of TieredHistory (raw 10s, 100ms/2min, 1s/30min, 10s/drive) for trending/graphing,
+           for the historysignals only (each history is ~270KB, too much to keep for every DBC signal).
+    currentdata - dict of TimeSeries(2) for current and last sample.
+
+    Timestamps are float seconds (epoch) taken once per frame from message.timestamp, so
+    every signal of a frame shares the receive time and render load doesn't skew them.
+    Values are decoded as numbers and stored in TimeSeries arrays. Enumerated signals
+    get their DBC choice names back when a sample is indexed (series[-1]).
     perftracker - performance data
     acceltracker - acceleration data
+    stats - frame counters, see getstats()
+
+    Only signals some consumer has subscribed to (see subscribe()) are decoded, through a
+    per arbitration id dispatch table. The trackers are always subscribed.
+    decodeall - decode every signal of every DBC message (for logging).
+    fastdecode - use generated decoders (see fastdecode.py), falling back to cantools per message.
+
+    boottiming - seconds spent on each startup step, see dbcache.loaddatabase()
+    dbcache - load the DBCs from the compiled cache next to them (rebuilt when they change)
+
+    Frames are read in batches: wait up to recvtimeout for one frame (so clearing isrunning
+    stops the thread promptly), then drain whatever is queued up to batchsize frames or
+    batchbudget seconds and decode them together.
+
+    snapshot - ReaderSnapshot of current values (subscribed signals only) and tracker state,
+    republished after a batch at most every snapshotperiod seconds. Renderers should read
+    canreader.snapshot once per frame rather than currentdata/perftracker/acceltracer so
+    every value on screen comes from the same instant.
+
+    filtersignals - optional set of signal names. When given, only the messages
+    carrying one of these (or a tracker signal) pass the kernel socket filter.
+    Otherwise every message in the DBCs passes. OBD responses always pass.
+
+    responsehandler - optional callable given every OBD response frame (0x7E8-0x7EF) before
+    it is decoded. It returns None to decode the frame as is, or a list of frames to decode
+    in its place, see OBDScheduler.onresponse().
     """
+    SPEEDSIGNAL = 'speed_average_non_driven'
+    LATSIGNAL = 'vehicle_stability_lateral_acceleration'
+    TRACKERSIGNALS = frozenset([SPEEDSIGNAL, LATSIGNAL])
 
     def __init__(self, group=None, target=None, name=None,
                  canbus='vcan0', bustype='socketcan',
-                 dbc=[], maxlen=1200, isrunning=Event()):
+                 dbc=[], tiers=HISTORYTIERS, historysignals=(), isrunning=Event(), filtersignals=None,
+                 decodeall=False, fastdecode=True, dbcache=True,
+                 batchsize=64, batchbudget=0.01, recvtimeout=0.1, snapshotperiod=0.02):
         super(CanReader, self).__init__(group=group, target=target,
                                         name=name)
 
-        self.can_bus = can.interface.Bus(canbus, bustype=bustype)
+        self.db, self.cansignals, self.boottiming = loaddatabase(dbc, usecache=dbcache)
+
+        self.canbus = canbus
+        self.canfilters = self._buildfilters(filtersignals)
+        self.can_bus = can.interface.Bus(canbus, bustype=bustype, can_filters=self.canfilters)
+
+        self.batchsize = batchsize
+        self.batchbudget = batchbudget
+        self.recvtimeout = recvtimeout
 
-        self.db = cantools.database.Database()
-        for dbcfile in dbc:
-            logging.warning(f'Loading {dbcfile} into reader database.')
-            self.db.add_dbc_file(dbcfile)
+        self.stats = Counter()
+        self._kernelrxstart = self._interfacerx()
         self.data = {}
         self.currentdata = {}
-        self.cansignals = {}
 
         self.running = isrunning
 
-        for message in self.db.messages:
-            signals = message.signals
-
-            for signal in signals:
-                self.cansignals[signal.name] = (CanSignal(signal.name,
-                                                          signal.minimum,
-                                                          signal.maximum,
-                                                          signal.unit,
-                                                          signal.comment))
-
+        dbsignals = {signal.name: signal for message in self.db.messages for signal in message.signals}
         for sig in self.cansignals:
-            self.data[sig] = deque(maxlen=maxlen)
-            self.currentdata[sig] = deque(maxlen=2)
+            labels, integer = self._valueformat(dbsignals[sig])
+            self.currentdata[sig] = TimeSeries(2, labels=labels, integer=integer)
+
+        for sig in set(historysignals) & set(self.cansignals):
+            self.data[sig] = TieredHistory(tiers)
 
         self.perftracker = PerfTracker()
         self.acceltracer = AccelTracker()
 
-    def _updatedata(self, sig, datapoint):
+        self.decodeall = decodeall
+        self.fastdecode = fastdecode
+        self._decoders = {}
+        self.subscriptions = {'trackers': CanReader.TRACKERSIGNALS}
+        self.responsehandler = None
+        self.dispatch = {}
+        self._dbframeids = frozenset(message.frame_id for message in self.db.messages)
+
+        start = time.monotonic()
+        self._builddispatch()
+        self.boottiming['dispatch'] = time.monotonic() - start
+
+        self.snapshotperiod = snapshotperiod
+        self._lastpublish = 0
+        self._dirty = False
+        self.snapshot = None
+        self.publish()
+
+    def subscribe(self, consumer, signalnames):
+        """Set the signals decoded on behalf of consumer, replacing its previous subscription"""
+        self.subscriptions[consumer] = frozenset(signalnames)
+        self._builddispatch()
+
+    def unsubscribe(self, consumer):
+        self.subscriptions.pop(consumer, None)
+        self._builddispatch()
+
+    def setdecodeall(self, decodeall):
+        self.decodeall = decodeall
+        self._builddispatch()
+
+    def subscribedsignals(self):
+        if self.decodeall:
+            return frozenset(self.cansignals)
+
+        return frozenset().union(*self.subscriptions.values())
+
+    @staticmethod
+    def _valueformat(signal):
+        """(labels, integer) for the TimeSeries of a signal, see TimeSeries"""
+        labels = None
+        if signal.choices:
+            labels = {raw * signal.scale + signal.offset: choice for raw, choice in signal.choices.items()}
+
+        integer = not signal.is_float and isinstance(signal.scale, int) and isinstance(signal.offset, int)
+
+        return labels, integer
+
+    def _decoder(self, message, signals):
+        """Decoder function for signals of message, generated once per signal set"""
+        if not self.fastdecode:
+            return partial(message.decode, decode_choices=False)
+
+        key = (message.frame_id, signals)
+        if key not in self._decoders:
+            self._decoders[key] = (compiledecoder(message, signals, decodechoices=False) or
+                                   partial(message.decode, decode_choices=False))
+
+        return self._decoders[key]
+
+    def _builddispatch(self):
+        """Rebuild the arbid -> (decoder, subscribed signal names) table and swap it in"""
+        wanted = self.subscribedsignals()
+        dispatch = {}
+
+        for message in self.db.messages:
+            signals = tuple(s.name for s in message.signals if s.name in wanted)
+            if signals:
+                dispatch[message.frame_id] = (self._decoder(message, signals), signals)
+
+        self.dispatch = dispatch
+        logging.info(f'Dispatching {len(dispatch)} messages, {len(wanted)} signals.')
+
+    def _buildfilters(self, filtersignals):
+        if filtersignals is not None:
+            filtersignals = set(filtersignals) | CanReader.TRACKERSIGNALS
+
+        canfilters = []
+        for message in self.db.messages:
+            if filtersignals is not None and filtersignals.isdisjoint(s.name for s in message.signals):
+                continue
+
+            canfilters.append({'can_id': message.frame_id,
+                               'can_mask': 0x1FFFFFFF if message.is_extended_frame else 0x7FF,
+                               'extended': message.is_extended_frame})
+
+        logging.warning(f'Filtering CANBUS to {len(canfilters)} of {len(self.db.messages)} DBC messages.')
+
+        canfilters.append({'can_id': OBDRESPONSEID, 'can_mask': OBDRESPONSEMASK, 'extended': False})
+
+        return canfilters
+
+    def _interfacerx(self):
+        """Frames received by the interface, from the kernel netdev counters. None if unavailable."""
+        try:
+            with open(f'/sys/class/net/{self.canbus}/statistics/rx_packets') as rxfile:
+                return int(rxfile.read())
+        except (OSError, ValueError):
+            return None
+
+    def getstats(self):
+        """Frame counters since start
+
+        frames - frames that reached python
+        decoded - frames decoded against the DBCs
+        unsubscribed - DBC frames skipped because no consumer wants their signals
+        rejected_python - frames that reached python but had no DBC message
+        rejected_kernel - frames dropped by the socket filter (None if the interface has no counters)
+        wakeups - batches drained from the socket, framesperwakeup/batchtime_ms their averages
+        maxbatch - largest batch seen
+        """
+        stats = dict(self.stats)
+        stats.setdefault('frames', 0)
+
+        wakeups = stats.pop('wakeups', 0)
+        batchframes = stats.pop('batchframes', 0)
+        batchtime = stats.pop('batchtime', 0)
+        stats['wakeups'] = wakeups
+        stats['framesperwakeup'] = batchframes / wakeups if wakeups else 0
+        stats['batchtime_ms'] = batchtime * 1000 / wakeups if wakeups else 0
+
+        kernelrx = self._interfacerx()
+        if kernelrx is None or self._kernelrxstart is None:
+            stats['rejected_kernel'] = None
+        else:
+            stats['rejected_kernel'] = max(kernelrx - self._kernelrxstart - stats['frames'], 0)
+
+        return stats
+
+    def recvbatch(self):
+        """Wait up to recvtimeout for a frame, then drain what is already queued on the socket
+
+        Stops at batchsize frames or after batchbudget seconds. Empty list on timeout.
+        """
+        # With unpublished samples, only wait as long as the snapshot may lag
+        message = self.can_bus.recv(timeout=self.snapshotperiod if self._dirty else self.recvtimeout)
+        if message is None:
+            return []
+
+        batch = [message]
+        deadline = time.monotonic() + self.batchbudget
+
+        while len(batch) < self.batchsize and time.monotonic() < deadline:
+            message = self.can_bus.recv(timeout=0)
+            if message is None:
+                break
+            batch.append(message)
+
+        return batch
+
+    def processbatch(self, batch):
+        """Decode a batch of frames into the data store and trackers"""
+        start = time.monotonic()
+
+        for message in batch:
+            self.processframe(message)
+
+        self.stats['wakeups'] += 1
+        self.stats['batchframes'] += len(batch)
+        self.stats['batchtime'] += time.monotonic() - start
+        self.stats['maxbatch'] = max(self.stats['maxbatch'], len(batch))
+
+        self._dirty = True
+        if start - self._lastpublish >= self.snapshotperiod:
+            self.publish()
+
+    def publish(self):
+        """Build a new ReaderSnapshot and swap it in with a single reference assignment"""
+        current = {}
+        for sig in self.subscribedsignals():
+            series = self.currentdata[sig]
+            if len(series):
+                current[sig] = series[-1][1]
+
+        version = self.snapshot.version + 1 if self.snapshot else 0
+        self.snapshot = ReaderSnapshot(version, time.time(), current,
+                                       self.perftracker.snapshot(), self.acceltracer.snapshot())
+        self._lastpublish = time.monotonic()
+        self._dirty = False
+
+    def processframe(self, message):
+        self.stats['frames'] += 1
+
+        if self.responsehandler is not None and message.arbitration_id & OBDRESPONSEMASK == OBDRESPONSEID:
+            # The handler may reassemble/split OBD responses into frames to decode instead
+            frames = self.responsehandler(message)
+            if frames is not None:
+                for frame in frames:
+                    self.decodeframe(frame)
+                return
+
+        self.decodeframe(message)
+
+    def decodeframe(self, message):
+        entry = self.dispatch.get(message.arbitration_id)
+        if entry is None:
+            if message.arbitration_id in self._dbframeids:
+                self.stats['unsubscribed'] += 1
+            else:
+                self.stats['rejected_python'] += 1
+            return
+
+        decode, signals = entry
+        # One receive time per frame, from the kernel/hardware timestamp where there is one
+        timestamp = message.timestamp or time.time()
         try:
-            sampletimedelta = datapoint[0] - self.data[sig][-1][0]
+            newdata = decode(message.data)
 
-            if sampletimedelta / datetime.timedelta(milliseconds=1) > 100:
-                self.data[sig].append(datapoint)
+            for sig in signals:
+                if sig not in newdata:
+                    continue
 
-        except IndexError:
-            self.data[sig].append(datapoint)
+                value = newdata[sig]
+                self.currentdata[sig].append(timestamp, value)
+                history = self.data.get(sig)
+                if history is not None:
+                    history.append(timestamp, value)
 
-    def run(self):
-        while self.running.is_set():
-            message = self.can_bus.recv()
-            if message:
-                try:
-                    newdata = self.db.decode_message(message.arbitration_id, message.data)
+                if sig == CanReader.SPEEDSIGNAL:
+                    self.perftracker.tick(self.currentdata[sig])
+                    self.acceltracer.updateaccel(self.currentdata[sig])
 
-                    for sig in newdata:
-                        datapoint = (datetime.datetime.now(), newdata[sig])
-                        self.currentdata[sig].append(datapoint)
-                        self._updatedata(sig, datapoint)
+                if sig == CanReader.LATSIGNAL:
+                    self.acceltracer.updatelat(self.currentdata[sig])
 
-                        if sig == 'speed_average_non_driven':
-                            self.perftracker.tick(self.currentdata[sig])
-                            self.acceltracer.updateaccel(self.currentdata[sig])
+            self.stats['decoded'] += 1
 
-                        if sig == 'vehicle_stability_lateral_acceleration':
-                            self.acceltracer.updatelat(self.currentdata[sig])
+        except Exception:
+            logging.exception(f'Packet decode failed for arbid {message.arbitration_id}')
 
-                except KeyError:
-                    pass
-                except Exception:
-                    logging.exception(f'Packet decode failed for arbid {message.arbitration_id}')
+    def run(self):
+        while self.running.is_set():
+            batch = self.recvbatch()
+            if batch:
+                self.processbatch(batch)
+            elif self._dirty:
+                self.publish()
 
 
 class AccelTracker(object):
@@ -105,7 +355,10 @@ class AccelTracker(object):
         try:
             lastspeed = speeddata[-2]
             curspeed = speeddata[-1]
-            self.accel = (curspeed[1] - lastspeed[1]) * 0.277778 / (curspeed[0] - lastspeed[0]).total_seconds()
+            if curspeed[0] <= lastspeed[0]:
+                return
+
+            self.accel = (curspeed[1] - lastspeed[1]) * 0.277778 / (curspeed[0] - lastspeed[0])
             self.setminmax()
 
             self.history.append((self.lat, self.accel))
@@ -132,6 +385,10 @@ class AccelTracker(object):
         self.latminmax[0] = min(self.latminmax[0], self.lat)
         self.latminmax[1] = max(self.latminmax[1], self.lat)
 
+    def snapshot(self):
+        return AccelSnapshot(self.lat, self.accel, tuple(self.latminmax), tuple(self.accelminmax),
+                             tuple(self.history))
+
 
 class PerfTracker(object):
     UNKNOWN = 0
@@ -149,6 +406,10 @@ class PerfTracker(object):
         self.distance = 0
         self.starttime = 0
 
+    def snapshot(self):
+        return PerfSnapshot(self.state, self.curr_et, self.distance,
+                            dict(self.current_result), dict(self.results[-1]))
+
     def genPerfResult(self):
         return {
             '0-60': 0,
@@ -172,10 +433,10 @@ class PerfTracker(object):
                 self.resetcounters(speeddata)
 
         if self.state == PerfTracker.RUNNING:
-            self.curr_et = (speeddata[-1][0] - self.starttime).total_seconds()
+            self.curr_et = speeddata[-1][0] - self.starttime
             self.distance += (
                 ((speeddata[-1][1] + speeddata[-2][1])/2) * 0.27777777 *
-                (speeddata[-1][0] - speeddata[-2][0]).total_seconds() * 0.000621371)
+                (speeddata[-1][0] - speeddata[-2][0]) * 0.000621371)
 
             if speeddata[-1][1] > 96.5 and self.current_result['0-60'] == 0:
                 self.current_result['0-60'] = self.curr_et
@@ -207,3 +468,4 @@ if __name__ == '__main__':
                          isrunning=e)
 
     pprint(myreader.cansignals)
+    pprint(myreader.getstats())
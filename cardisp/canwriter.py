@@ -1,62 +1,441 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 import can
-from threading import Thread, Event
+from threading import Thread, Event, Lock
 import time
-from collections import namedtuple
-import random
+import heapq
+import bisect
+from collections import namedtuple, Counter
 import logging
 
-OBDPid = namedtuple('OBDPid', ['name', 'arbid', 'data', 'frequency'])
+from isotp import IsoTpReceiver, SINGLE
+
+# frequency - seconds between requests, signals - the m22_obd.dbc signals carried by the response,
+# length - data bytes the DID answers with (needed to split multi-DID responses)
+OBDPid = namedtuple('OBDPid', ['name', 'arbid', 'data', 'frequency', 'signals', 'length'], defaults=[(), 1])
 
 sendpids = [
-    OBDPid('Calc Engine Load', 0x7df, [0x03, 0x22,  0x00, 0x04, 0x00, 0x00, 0x00, 0x00], 1),
-    OBDPid('STFTB1', 0x7df, [0x03, 0x22, 0x00, 0x06, 0x00, 0x00, 0x00, 0x00], 1),
-    OBDPid('LTFTB1', 0x7df, [0x03, 0x22, 0x00, 0x07, 0x00, 0x00, 0x00, 0x00], 5),
-    OBDPid('STFTB2', 0x7df, [0x03, 0x22, 0x00, 0x08, 0x00, 0x00, 0x00, 0x00], 1),
-    OBDPid('LTFTB2', 0x7df, [0x03, 0x22, 0x00, 0x09, 0x00, 0x00, 0x00, 0x00], 5),
-    OBDPid('Timing', 0x7df, [0x03, 0x22, 0x00, 0x0e, 0x00, 0x00, 0x00, 0x00], 1),
-    OBDPid('O2_S1', 0x7df, [0x03, 0x22, 0x00, 0x14, 0x00, 0x00, 0x00, 0x00], 0.5),
-    OBDPid('O2_S2', 0x7df, [0x03, 0x22, 0x00, 0x15, 0x00, 0x00, 0x00, 0x00], 0.5),
-    OBDPid('O2_S3', 0x7df, [0x03, 0x22, 0x00, 0x16, 0x00, 0x00, 0x00, 0x00], 0.5),
-    OBDPid('O2_S4', 0x7df, [0x03, 0x22, 0x00, 0x17, 0x00, 0x00, 0x00, 0x00], 0.5),
-    OBDPid('IAT2', 0x7df, [0x03, 0x22, 0x20, 0x06, 0x00, 0x00, 0x00, 0x00], 2.5),
-    OBDPid('KnockRetard', 0x7df, [0x03, 0x22, 0x11, 0xA6, 0x00, 0x00, 0x00, 0x00], 0.5),
-    OBDPid('MAF', 0x7df, [0x03, 0x22, 0x00, 0x10, 0x00, 0x00, 0x00, 0x00], 0.5)]
-
-
-class CanWriter(Thread):
-    def __init__(self, group=None, target=None, name=None,
-                 canbus='vcan0', bustype='socketcan', pid=None, isrunning=None):
-        super(CanWriter, self).__init__(group=group, target=target, name=name)
-
-        self.can_bus = can.interface.Bus(canbus, bustype=bustype)
+    OBDPid('Calc Engine Load', 0x7df, [0x03, 0x22,  0x00, 0x04, 0x00, 0x00, 0x00, 0x00], 1, ('O_CalcEngineLoad',)),
+    OBDPid('STFTB1', 0x7df, [0x03, 0x22, 0x00, 0x06, 0x00, 0x00, 0x00, 0x00], 1, ('O_ShortFuelTrimBank1',)),
+    OBDPid('LTFTB1', 0x7df, [0x03, 0x22, 0x00, 0x07, 0x00, 0x00, 0x00, 0x00], 5, ('O_LongFuelTrimBank1',)),
+    OBDPid('STFTB2', 0x7df, [0x03, 0x22, 0x00, 0x08, 0x00, 0x00, 0x00, 0x00], 1, ('O_ShortFuelTrimBank2',)),
+    OBDPid('LTFTB2', 0x7df, [0x03, 0x22, 0x00, 0x09, 0x00, 0x00, 0x00, 0x00], 5, ('O_LongFuelTrimBank2',)),
+    OBDPid('Timing', 0x7df, [0x03, 0x22, 0x00, 0x0e, 0x00, 0x00, 0x00, 0x00], 1, ('O_TimingAdvance',)),
+    OBDPid('O2_S1', 0x7df, [0x03, 0x22, 0x00, 0x14, 0x00, 0x00, 0x00, 0x00], 0.5,
+           ('O_OxySensor1_Volt', 'O_OxySensor1_STFT'), 2),
+    OBDPid('O2_S2', 0x7df, [0x03, 0x22, 0x00, 0x15, 0x00, 0x00, 0x00, 0x00], 0.5,
+           ('O_OxySensor2_Volt', 'O_OxySensor2_STFT'), 2),
+    OBDPid('O2_S3', 0x7df, [0x03, 0x22, 0x00, 0x16, 0x00, 0x00, 0x00, 0x00], 0.5,
+           ('O_OxySensor3_Volt', 'O_OxySensor3_STFT'), 2),
+    OBDPid('O2_S4', 0x7df, [0x03, 0x22, 0x00, 0x17, 0x00, 0x00, 0x00, 0x00], 0.5,
+           ('O_OxySensor4_Volt', 'O_OxySensor4_STFT'), 2),
+    OBDPid('IAT2', 0x7df, [0x03, 0x22, 0x20, 0x06, 0x00, 0x00, 0x00, 0x00], 2.5, ('OE_IntakeAirTemp2',)),
+    OBDPid('KnockRetard', 0x7df, [0x03, 0x22, 0x11, 0xA6, 0x00, 0x00, 0x00, 0x00], 0.5, ('OE_KnockRetard',)),
+    OBDPid('MAF', 0x7df, [0x03, 0x22, 0x00, 0x10, 0x00, 0x00, 0x00, 0x00], 0.5, ('O_MAFAirFlowRate',), 2)]
+
+# Round trip latency histogram upper bucket edges in ms, plus one open ended bucket
+LATENCYBUCKETS = (5, 10, 20, 50, 100, 200, 500)
+
+
+class OBDPidStats(object):
+    """Request/response counters and round trip latency histogram of one pid
+
+    misses - consecutive timeouts/negative responses, reset by an answer
+    """
+
+    def __init__(self):
+        self.sent = 0
+        self.answered = 0
+        self.negative = 0
+        self.timeouts = 0
+        self.misses = 0
+        self.dropped = False
+        self.latency = [0] * (len(LATENCYBUCKETS) + 1)
+        self.latencysum = 0.0
+        self.started = time.monotonic()
+
+    def answer(self, latency):
+        self.answered += 1
+        self.misses = 0
+        self.latencysum += latency
+        self.latency[bisect.bisect_left(LATENCYBUCKETS, latency * 1000)] += 1
+
+    def percentile(self, fraction):
+        """Upper edge (ms) of the histogram bucket holding the fraction-th answer, None if unanswered"""
+        target = fraction * self.answered
+        total = 0
+        for edge, count in zip(LATENCYBUCKETS + (None,), self.latency):
+            total += count
+            if count and total >= target:
+                return edge
+
+        return None
+
+    def summary(self):
+        elapsed = time.monotonic() - self.started
+        return {'sent': self.sent,
+                'answered': self.answered,
+                'negative': self.negative,
+                'timeouts': self.timeouts,
+                'answerrate': self.answered / self.sent if self.sent else 0,
+                'rate': self.answered / elapsed if elapsed else 0,
+                'latency_ms': self.latencysum * 1000 / self.answered if self.answered else None,
+                'latency_p95_ms': self.percentile(0.95),
+                'dropped': self.dropped}
+
+
+class OBDScheduler(Thread):
+    """Send all OBD requests from one thread on a deterministic slot plan
+
+    Requests go out at most one per slot of 1/maxrate seconds, which caps the request bus load.
+    Each pid is due every pid.frequency seconds (a period, despite the name); the first sends are
+    spread evenly over the shortest period and later ones stay on that grid, so with the same
+    pids the send order is always the same. When more is due than maxrate allows, the earliest
+    due request goes first and every pid slows down proportionally instead of bursting.
+
+    add(), remove() and rerate() take effect on the next slot, from any thread.
+
+    maxrate - request budget in requests/s, the slot cap above.
+    setvisible() shares that budget by what is on screen: pids with a visible signal are polled as
+    fast as the budget allows (no faster than every minperiod seconds), the others drop to every
+    backgroundperiod seconds (or their own period, if slower). Base periods are kept for add().
+    bus - send on this bus instead of opening canbus (e.g. the reader's bus on the asyncio engine).
+    Drive it with start() as a thread, or call step() from an event loop.
+
+    Responses (0x7E8-0x7EF frames, fed in by the reader through onresponse()) are matched to the
+    outstanding request by DID. Only one request per pid is in flight; one unanswered after
+    timeout seconds, or answered negatively, is a miss. Each consecutive miss doubles the pid's
+    period, and after maxmisses in a row the pid is dropped as unsupported.
+    stats - {name: OBDPidStats}, see getstats(). Logged every statsperiod seconds.
+
+    batchdids - DIDs packed into one Mode 22 request (up to 3 fit a single frame). Pids on the
+    same arbid that are due within half a period ride along with the one due now. Multi-frame
+    answers are reassembled (see isotp.py) and split back into single-DID frames for the reader.
+    A negative response while a packed request is the only one in flight switches packing off, as
+    the ECU doesn't take it. packretry answers in a row without a miss later, packing is tried again;
+    packretry doubles with every retry, so an ECU that never takes it costs fewer and fewer requests.
+    """
+
+    def __init__(self, canbus='vcan0', bustype='socketcan', pids=sendpids, maxrate=20,
+                 isrunning=None, bus=None, minperiod=0.1, backgroundperiod=5,
+                 timeout=0.5, maxmisses=5, statsperiod=60, batchdids=3, packretry=50):
+        super(OBDScheduler, self).__init__(name='OBDScheduler')
+
+        self.can_bus = bus or can.interface.Bus(canbus, bustype=bustype)
         self.isrunning = isrunning
-        self.pid = pid
+        self.maxrate = maxrate
+        self.slot = 1 / maxrate
+        self.minperiod = minperiod
+        self.backgroundperiod = backgroundperiod
+        self.timeout = timeout
+        self.maxmisses = maxmisses
+        self.statsperiod = statsperiod
+        self.batchdids = batchdids
+        self.maxbatchdids = batchdids
+        self.packretry = packretry
+        self._cleananswers = 0
+        self.isotp = IsoTpReceiver(self.can_bus.send)
+        self.stats = {}
+        self.unsolicited = 0
+        self._lastsent = {}
+        self._outstanding = {}
+        self._dids = {}
+        self._lengths = {}
+        self._laststats = time.monotonic()
 
-    def run(self):
-        msg = can.Message(arbitration_id=self.pid.arbid, data=self.pid.data, is_extended_id=False)
-        task = self.can_bus.send_periodic(msg, self.pid.frequency)
-        assert isinstance(task, can.CyclicSendTaskABC)
+        self.pids = {}
+        self.basepids = {}
+        self._messages = {}
+        self._generation = Counter()
+        self._due = []
+        self._nextslot = 0
+        self._lock = Lock()
+        self._wake = Event()
 
-        while self.isrunning.is_set():
-            time.sleep(0.1)
+        now = time.monotonic()
+        if pids:
+            spacing = max(min(pid.frequency for pid in pids) / len(pids), self.slot)
+            for i, pid in enumerate(pids):
+                self.add(pid, start=now + i * spacing)
+
+        demand = sum(1 / pid.frequency for pid in pids)
+        logging.warning(f'OBD schedule: {len(pids)} pids, {demand:.1f} requests/s, capped at {maxrate}/s')
+
+    def add(self, pid, start=None):
+        """Schedule pid (replacing one with the same name), first send at start (monotonic, default now)"""
+        with self._lock:
+            self.pids[pid.name] = pid
+            self.basepids[pid.name] = pid
+            self._messages[pid.name] = can.Message(arbitration_id=pid.arbid, data=pid.data, is_extended_id=False)
+            self._dids[pid.name] = pid.data[2] << 8 | pid.data[3]
+            self._lengths[self._dids[pid.name]] = pid.length
+            self.stats.setdefault(pid.name, OBDPidStats()).dropped = False
+            self._generation[pid.name] += 1
+            heapq.heappush(self._due, (start or time.monotonic(), self._generation[pid.name], pid.name))
+
+        self._wake.set()
+
+    def remove(self, name):
+        with self._lock:
+            self._remove(name)
+
+    def _remove(self, name):
+        self.pids.pop(name, None)
+        self.basepids.pop(name, None)
+        self._messages.pop(name, None)
+        # Its heap entry is dropped when it comes up
+        self._generation[name] += 1
+
+    def rerate(self, name, period):
+        """Send name every period seconds, starting one period after its last send"""
+        with self._lock:
+            pid = self.pids.get(name)
+            if pid is None:
+                return
+
+            self.pids[name] = pid._replace(frequency=period)
+            self._generation[name] += 1
+            last = self._lastsent.get(name)
+            start = last + period if last else time.monotonic()
+            heapq.heappush(self._due, (start, self._generation[name], name))
+
+        self._wake.set()
+
+    def setvisible(self, signalnames):
+        """Re-rate every pid for the signals now on screen, see the class docstring"""
+        visible = set(signalnames)
+        periods = {}
+
+        with self._lock:
+            foreground = [name for name, pid in self.basepids.items() if visible.intersection(pid.signals)]
+            for name, pid in self.basepids.items():
+                if name not in foreground:
+                    periods[name] = max(pid.frequency, self.backgroundperiod)
+
+            spare = self.maxrate - sum(1 / period for period in periods.values())
+            for name in foreground:
+                periods[name] = max(len(foreground) / spare, self.minperiod) if spare > 0 else self.backgroundperiod
+
+            changed = {name: period for name, period in periods.items() if period != self.pids[name].frequency}
+
+        for name, period in changed.items():
+            self.rerate(name, period)
+
+        if changed:
+            logging.warning(f'OBD schedule: {len(foreground)} pids on screen at '
+                            f'{1 / periods[foreground[0]] if foreground else 0:.1f}/s each, '
+                            f'{len(periods) - len(foreground)} in background')
+
+    def onresponse(self, message):
+        """Match a frame from an OBD responder (0x7E8-0x7EF) to its outstanding requests
+
+        Returns None when message should be decoded as it is, otherwise the frames to decode
+        in its place: none while a multi-frame answer is incomplete, then one frame per DID laid
+        out like a single-DID single-frame answer, so the m22_obd.dbc definitions decode it.
+        """
+        received = message.timestamp or time.time()
+
+        with self._lock:
+            payload = self.isotp.feed(message)
+            if payload is None:
+                return []
+
+            if payload[0] == 0x62:
+                answers = self._answer(payload, received)
+                if message.data[0] >> 4 == SINGLE and len(answers) <= 1:
+                    return None
+
+                return [can.Message(arbitration_id=message.arbitration_id, timestamp=received, is_extended_id=False,
+                                    data=bytes([3 + len(value), 0x62, did >> 8, did & 0xFF]) + value.ljust(4, b'\0'))
+                        for did, value in answers if len(value) <= 4]
 
-        self.can_bus.stop_all_periodic_tasks()
+            if payload[0] == 0x7F and len(payload) >= 3 and payload[1] == 0x22:
+                self._negative(payload[2])
+                return []
 
-        logging.warning(f"stopped cyclic send of pid {self.pid.name}")
+        return None
+
+    def _answer(self, payload, received):
+        """Split a positive response into (did, value) and credit the outstanding requests"""
+        answers = []
+        i = 1
+        while i + 2 <= len(payload):
+            did = payload[i] << 8 | payload[i + 1]
+            length = self._lengths.get(did)
+            if length is None:
+                # Unknown DID, can't tell where the next one starts
+                self.unsolicited += 1
+                break
+
+            answers.append((did, payload[i + 2:i + 2 + length]))
+            i += 2 + length
+
+            entry = self._outstanding.pop(did, None)
+            if entry is None:
+                self.unsolicited += 1
+                continue
+
+            name, sentat = entry
+            self.stats[name].answer(received - sentat)
+
+            self._cleananswers += 1
+            if self.batchdids < self.maxbatchdids and self._cleananswers >= self.packretry:
+                self.batchdids = self.maxbatchdids
+                logging.warning(f'OBD trying {self.batchdids} DID requests again after {self._cleananswers} answers')
+                # Wait longer before the next retry, should the ECU reject this one too
+                self.packretry *= 2
+
+        return answers
+
+    def _negative(self, code):
+        # 0x78 - response pending, the answer is still coming
+        if code == 0x78 or not self._outstanding:
+            return
+
+        # Negative responses carry no DID. With more than one request in flight (or a late answer to
+        # one already expired) there's no telling which it was for, so leave them to time out.
+        if len({sentat for _, sentat in self._outstanding.values()}) > 1:
+            return
+
+        request = list(self._outstanding)
+        if len(request) > 1:
+            self.batchdids = 1
+            self._cleananswers = 0
+            self._outstanding.clear()
+            logging.warning(f'OBD ECU rejected a {len(request)} DID request (NRC {code:#x}), sending DIDs one by one')
+            return
+
+        name, _ = self._outstanding.pop(request[0])
+        self.stats[name].negative += 1
+        self._miss(name)
+
+    def _miss(self, name):
+        stats = self.stats[name]
+        stats.misses += 1
+        self._cleananswers = 0
+
+        if stats.misses >= self.maxmisses and name in self.pids:
+            stats.dropped = True
+            self._remove(name)
+            logging.warning(f'OBD pid {name} dropped after {stats.misses} misses in a row')
+
+    def _expire(self, wallclock):
+        for did, (name, sentat) in list(self._outstanding.items()):
+            if wallclock - sentat > self.timeout:
+                del self._outstanding[did]
+                self.stats[name].timeouts += 1
+                self._miss(name)
+
+    def getstats(self):
+        """{name: OBDPidStats.summary()} for every pid scheduled so far, dropped ones included"""
+        with self._lock:
+            return {name: stats.summary() for name, stats in self.stats.items()}
+
+    def logstats(self):
+        for name, stats in self.getstats().items():
+            latency = f'{stats["latency_ms"]:.0f}ms (p95 <{stats["latency_p95_ms"]}ms)' if stats['answered'] else '-'
+            logging.warning(f'OBD {name}: {stats["answered"]}/{stats["sent"]} answered '
+                            f'({stats["answerrate"]:.0%}, {stats["rate"]:.2f}/s), latency {latency}, '
+                            f'{stats["timeouts"]} timeouts, {stats["negative"]} negative'
+                            f'{", dropped" if stats["dropped"] else ""}')
+
+    def step(self, now):
+        """Send the request due in this slot, if any. Returns seconds until the next step is needed."""
+        if now - self._laststats >= self.statsperiod:
+            self._laststats = now
+            self.logstats()
+
+        with self._lock:
+            self._expire(time.time())
+
+            if now < self._nextslot:
+                return self._nextslot - now
+
+            while self._due:
+                due, generation, name = self._due[0]
+                if generation != self._generation[name] or name not in self.pids:
+                    heapq.heappop(self._due)
+                    continue
+
+                if due > now:
+                    return due - now
+
+                pid = self.pids[name]
+                stats = self.stats[name]
+                # Stay on the grid unless a whole period behind, backing off while the pid keeps missing
+                period = pid.frequency * 2 ** stats.misses
+                heapq.heapreplace(self._due, (max(due + period, now), generation, name))
+
+                if self._dids[name] in self._outstanding:
+                    # Still waiting for the last answer, give the slot to the next pid
+                    continue
+
+                # A pid that keeps missing goes alone, so it can't sink a packed request
+                request = [name] + (self._packwith(name, now) if not stats.misses else [])
+                self._send(request, now)
+                self._nextslot = now + self.slot
+
+                return self.slot
+
+        return 1.0
+
+    def _packwith(self, name, now):
+        """Pids to ride along with name: same arbid, answering, not in flight, due within half a period"""
+        arbid = self.pids[name].arbid
+        packed = []
+
+        for due, generation, other in sorted(self._due):
+            if len(packed) + 1 >= self.batchdids:
+                break
+
+            pid = self.pids.get(other)
+            if (pid is None or other == name or other in packed or generation != self._generation[other]
+                    or pid.arbid != arbid or self.stats[other].misses or self._dids[other] in self._outstanding
+                    or due > now + pid.frequency / 2):
+                continue
+
+            packed.append(other)
+            # Supersede its heap entry with the next slot on its grid
+            self._generation[other] += 1
+            heapq.heappush(self._due, (max(due + pid.frequency, now), self._generation[other], other))
+
+        return packed
+
+    def _send(self, names, now):
+        if len(names) == 1:
+            message = self._messages[names[0]]
+        else:
+            dids = [self._dids[name] for name in names]
+            data = [1 + 2 * len(dids), 0x22] + [byte for did in dids for byte in (did >> 8, did & 0xFF)]
+            message = can.Message(arbitration_id=self.pids[names[0]].arbid, data=data + [0] * (8 - len(data)),
+                                  is_extended_id=False)
+
+        sentat = time.time()
+        try:
+            self.can_bus.send(message)
+        except can.CanError:
+            logging.warning(f'OBD request {", ".join(names)} not sent')
+            return
+
+        for name in names:
+            self._outstanding[self._dids[name]] = (name, sentat)
+            self.stats[name].sent += 1
+            self._lastsent[name] = now
+
+    def run(self):
+        while self.isrunning.is_set():
+            self._wake.clear()
+            self._wake.wait(min(self.step(time.monotonic()), 0.1))
+
+        self.can_bus.shutdown()
+        logging.warning('stopped OBD requests')
 
 
 if __name__ == '__main__':
     isrunning = Event()
     isrunning.set()
-    writers = []
-    for pid in sendpids:
-        writer = CanWriter(canbus='vcan0', pid=pid, isrunning=isrunning)
-        writer.start()
-        writers.append(writer)
-
-        time.sleep(random.random())
+    scheduler = OBDScheduler('vcan0', isrunning=isrunning)
+    scheduler.start()
 
     while True:
         try:
@@ -65,8 +444,7 @@ if __name__ == '__main__':
             break
 
     isrunning.clear()
-
-    for writer in writers:
-        writer.join()
+    scheduler.join()
+    scheduler.logstats()
 
     exit(1)
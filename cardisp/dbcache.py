@@ -0,0 +1,124 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import os
+import sys
+import time
+import pickle
+import hashlib
+import logging
+from collections import namedtuple
+
+import cantools
+
+CanSignal = namedtuple('CanSignal',
+                       ['name', 'minimum', 'maximum', 'unit', 'comment'])
+
+CACHEDIR = '.dbcache'
+CACHEVERSION = 1
+
+
+def _digest(dbcfiles):
+    """Hash of the DBC contents plus everything that changes the pickle format"""
+    sha = hashlib.sha1()
+    sha.update(f'{CACHEVERSION} {cantools.__version__} {sys.version_info[:2]}'.encode())
+
+    for dbcfile in dbcfiles:
+        sha.update(os.path.basename(dbcfile).encode())
+        with open(dbcfile, 'rb') as f:
+            sha.update(f.read())
+
+    return sha.hexdigest()
+
+
+def _cachepath(dbcfiles, digest):
+    return os.path.join(os.path.dirname(os.path.abspath(dbcfiles[0])), CACHEDIR, f'{digest}.pickle')
+
+
+def builddatabase(dbcfiles):
+    """Parse the DBCs and build the signal registry"""
+    db = cantools.database.Database()
+    for dbcfile in dbcfiles:
+        logging.warning(f'Loading {dbcfile} into reader database.')
+        db.add_dbc_file(dbcfile)
+
+    cansignals = {}
+    for message in db.messages:
+        for signal in message.signals:
+            cansignals[signal.name] = CanSignal(signal.name,
+                                                signal.minimum,
+                                                signal.maximum,
+                                                signal.unit,
+                                                signal.comment)
+
+    return db, cansignals
+
+
+def _writecache(cachepath, db, cansignals):
+    cachedir = os.path.dirname(cachepath)
+    try:
+        os.makedirs(cachedir, exist_ok=True)
+        for stale in os.listdir(cachedir):
+            if stale.endswith('.pickle'):
+                os.remove(os.path.join(cachedir, stale))
+
+        tmppath = f'{cachepath}.{os.getpid()}.tmp'
+        with open(tmppath, 'wb') as f:
+            pickle.dump((db, cansignals), f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmppath, cachepath)
+    except OSError:
+        logging.exception(f'Could not write DBC cache {cachepath}')
+
+
+def loaddatabase(dbcfiles, usecache=True):
+    """Return (db, cansignals, timing) for the DBCs, from the compiled cache when it is current
+
+    The cache lives in .dbcache/ next to the first DBC, keyed by the content hash of all
+    the DBCs, so editing any of them rebuilds it on the next start.
+    timing - dict of seconds spent hashing, loading the cache and/or parsing, plus 'cachehit'.
+    """
+    timing = {'cachehit': False}
+    if not dbcfiles:
+        return cantools.database.Database(), {}, timing
+
+    start = time.monotonic()
+    digest = _digest(dbcfiles) if usecache else None
+    timing['hash'] = time.monotonic() - start
+
+    cachepath = _cachepath(dbcfiles, digest) if usecache else None
+
+    if usecache and os.path.exists(cachepath):
+        start = time.monotonic()
+        try:
+            with open(cachepath, 'rb') as f:
+                db, cansignals = pickle.load(f)
+            timing['cacheload'] = time.monotonic() - start
+            timing['cachehit'] = True
+            logging.warning(f'Loaded DBC cache {cachepath} in {timing["cacheload"] * 1000:.0f}ms')
+
+            return db, cansignals, timing
+        except Exception:
+            logging.exception(f'DBC cache {cachepath} unreadable, rebuilding')
+
+    start = time.monotonic()
+    db, cansignals = builddatabase(dbcfiles)
+    timing['parse'] = time.monotonic() - start
+    logging.warning(f'Parsed {len(dbcfiles)} DBCs in {timing["parse"] * 1000:.0f}ms')
+
+    if usecache:
+        start = time.monotonic()
+        _writecache(cachepath, db, cansignals)
+        timing['cachewrite'] = time.monotonic() - start
+
+    return db, cansignals, timing
+
+
+if __name__ == '__main__':
+    dbcfiles = sys.argv[1:] or ['canbus_dbc/gm_global_a_hs.dbc', 'canbus_dbc/m22_obd.dbc']
+
+    _, _, parsed = loaddatabase(dbcfiles, usecache=False)
+    loaddatabase(dbcfiles)
+    _, _, cached = loaddatabase(dbcfiles)
+
+    print(f'parse: {parsed["parse"] * 1000:.1f}ms  '
+          f'cache: {(cached["hash"] + cached["cacheload"]) * 1000:.1f}ms '
+          f'(hash {cached["hash"] * 1000:.1f}ms)')
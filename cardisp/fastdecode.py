@@ -0,0 +1,155 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import logging
+import random
+from functools import partial
+
+FALLBACK_REASONS = {}
+
+
+def _shift(signal, length):
+    """Right shift to bring the signal LSB to bit 0 of the frame as an integer
+
+    little endian signals index the frame as int.from_bytes(data, 'little'),
+    big endian (motorola) signals as int.from_bytes(data, 'big').
+    """
+    if signal.byte_order == 'little_endian':
+        return signal.start
+
+    # DBC big endian start is the MSB in sawtooth numbering
+    msb = (signal.start // 8) * 8 + (7 - signal.start % 8)
+    lsb = msb + signal.length - 1
+
+    return (8 * length) - 1 - lsb
+
+
+def _unsupported(message, signals):
+    if getattr(message, 'is_container', False):
+        return 'container message'
+    if message.is_multiplexed():
+        return 'multiplexed message'
+    if not message.length:
+        return 'zero length message'
+
+    for signal in signals:
+        if signal.is_float:
+            return f'float signal {signal.name}'
+
+    return None
+
+
+def _source(message, signals, decodechoices):
+    length = message.length
+    lines = ['def decode(data):',
+             f'    if len(data) != {length}:',
+             '        return fallback(data)']
+
+    if any(s.byte_order == 'big_endian' for s in signals):
+        lines.append("    be = from_bytes(data, 'big')")
+    if any(s.byte_order == 'little_endian' for s in signals):
+        lines.append("    le = from_bytes(data, 'little')")
+
+    consts = {}
+    result = []
+
+    for i, signal in enumerate(signals):
+        frame = 'be' if signal.byte_order == 'big_endian' else 'le'
+        mask = (1 << signal.length) - 1
+        lines.append(f'    r{i} = ({frame} >> {_shift(signal, length)}) & {mask:#x}')
+
+        if signal.is_signed:
+            lines.append(f'    if r{i} & {1 << (signal.length - 1):#x}:')
+            lines.append(f'        r{i} -= {1 << signal.length:#x}')
+
+        scaled = f'r{i} * {signal.scale!r} + {signal.offset!r}'
+
+        if decodechoices and signal.choices:
+            consts[f'c{i}'] = dict(signal.choices)
+            scaled = f'c{i}[r{i}] if r{i} in c{i} else {scaled}'
+
+        result.append(f'        {signal.name!r}: {scaled},')
+
+    lines.append('    return {')
+    lines.extend(result)
+    lines.append('    }')
+
+    return '\n'.join(lines), consts
+
+
+def _matches(fast, reference, signalnames):
+    for name in signalnames:
+        if name not in fast or fast[name] != reference[name] or type(fast[name]) is not type(reference[name]):
+            return False
+
+    return True
+
+
+def verify(decoder, message, signalnames, samples=64, decodechoices=True):
+    """Compare decoder against cantools on edge and random payloads of the message length"""
+    rnd = random.Random(message.frame_id)
+    payloads = [bytes(message.length), b'\xff' * message.length]
+    payloads += [bytes(rnd.getrandbits(8) for _ in range(message.length)) for _ in range(samples)]
+
+    for data in payloads:
+        try:
+            reference = message.decode(data, decode_choices=decodechoices)
+        except Exception:
+            continue
+
+        if not _matches(decoder(data), reference, signalnames):
+            return False
+
+    return True
+
+
+def compiledecoder(message, signalnames=None, decodechoices=True):
+    """Generate a decoder for message returning a dict of the named signals (all if None)
+
+    decodechoices - as cantools decode_choices, False returns the scaled number for enumerations.
+
+    The decoder does one int.from_bytes per byte order and then constant shifts,
+    masks and scale/offset for each signal. Frames of the wrong length go to cantools.
+    Returns None for messages the generator doesn't support or which fail verification
+    against cantools - the caller should use message.decode for those.
+    """
+    if signalnames is None:
+        signalnames = [s.name for s in message.signals]
+
+    signals = [s for s in message.signals if s.name in signalnames]
+
+    reason = _unsupported(message, signals)
+    if reason is not None:
+        FALLBACK_REASONS[message.frame_id] = reason
+        return None
+
+    source, consts = _source(message, signals, decodechoices)
+    namespace = dict(consts, from_bytes=int.from_bytes,
+                     fallback=partial(message.decode, decode_choices=decodechoices))
+
+    try:
+        exec(compile(source, f'<fastdecode {message.name}>', 'exec'), namespace)
+    except Exception:
+        logging.exception(f'Decoder generation failed for {message.name}')
+        FALLBACK_REASONS[message.frame_id] = 'generation failed'
+        return None
+
+    decoder = namespace['decode']
+
+    if not verify(decoder, message, [s.name for s in signals], decodechoices=decodechoices):
+        logging.warning(f'Generated decoder for {message.name} does not match cantools, using cantools.')
+        FALLBACK_REASONS[message.frame_id] = 'verification failed'
+        return None
+
+    return decoder
+
+
+if __name__ == '__main__':
+    import sys
+    import cantools
+
+    db = cantools.database.load_file(sys.argv[1] if len(sys.argv) > 1 else 'canbus_dbc/gm_global_a_hs.dbc')
+
+    for message in db.messages:
+        decoder = compiledecoder(message)
+        print(f'{message.frame_id:#05x} {message.name:40} '
+              f'{"generated" if decoder else FALLBACK_REASONS[message.frame_id]}')
@@ -0,0 +1,212 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Frame pacing for the display loop
+
+The loop used to render, then sleep a fixed 50ms, then look for input: the frame rate
+was whatever rendering left of it and a key press waited up to a whole frame plus the
+sleep. FrameScheduler holds a frame period per mode, sleeps only for what rendering
+left of it, drops frame slots it can't make instead of trying to catch up, falls back
+to a lower rate while rendering keeps overrunning, and sleeps in select() on the input
+sources so a key press ends the sleep at once.
+"""
+import os
+import math
+import time
+import select
+import logging
+from queue import Queue, Empty
+
+
+class WakeQueue(Queue):
+    """Queue that select() can wait on: fileno() is readable once something was put
+
+    Items put from other threads (e.g. the asyncio engine's input events) wake a
+    FrameScheduler.wait() through a pipe instead of waiting to be polled.
+    """
+
+    def __init__(self, maxsize=0):
+        super(WakeQueue, self).__init__(maxsize)
+        self._read, self._write = os.pipe()
+        os.set_blocking(self._read, False)
+        os.set_blocking(self._write, False)
+
+    def put(self, item, block=True, timeout=None):
+        super(WakeQueue, self).put(item, block, timeout)
+        try:
+            os.write(self._write, b'\0')
+        except BlockingIOError:
+            # Pipe full of wakeups already, the reader is woken either way
+            pass
+
+    def fileno(self):
+        return self._read
+
+    def drain(self):
+        """Everything queued so far, as a list"""
+        try:
+            while os.read(self._read, 512):
+                pass
+        except BlockingIOError:
+            pass
+
+        items = []
+        while True:
+            try:
+                items.append(self.get_nowait())
+            except Empty:
+                return items
+
+
+class FrameScheduler(object):
+    """When to render the next frame, and sleeping until then or until input
+
+    fps - target frames per second, see setfps()
+    degradedfps - frames per second while degraded, fps / 2 if None
+    statsperiod - seconds between frame stats logs (see getstats()), None to not log
+
+    Frames are due every 1/fps from the previous frame's start, so a frame that takes
+    most of its budget only leaves the remainder to sleep. A frame that takes longer
+    skips the slots it ran into (counted, not rendered late) and the next frame is due
+    at the first slot after it.
+
+    load - smoothed render time as a share of the 1/fps budget
+    degraded - True from when load goes over 1 until it is back under 0.5; frames are
+               due every 1/degradedfps meanwhile
+    """
+    SMOOTHING = 0.2
+    DEGRADEAT = 1.0
+    RECOVERAT = 0.5
+
+    def __init__(self, fps=20, degradedfps=None, statsperiod=60):
+        self.period = 1 / fps
+        self.degradedperiod = 1 / (degradedfps or fps / 2)
+        self.statsperiod = statsperiod
+        self.nextframe = time.monotonic()
+
+        self.load = 0
+        self.degraded = False
+
+        self.frames = 0
+        self.skipped = 0
+        self.overbudget = 0
+        self.degradations = 0
+        self.rendertime = 0
+        self.worst = 0
+        self._started = None
+        self._statsstart = self._laststats = time.monotonic()
+
+    @property
+    def interval(self):
+        """Seconds between frames at the current rate"""
+        return self.degradedperiod if self.degraded else self.period
+
+    def setfps(self, fps, degradedfps=None):
+        """Change the target frame rates (e.g. on a mode change), from the next frame on"""
+        interval = self.interval
+        self.period = 1 / fps
+        self.degradedperiod = 1 / (degradedfps or fps / 2)
+        self.nextframe += self.interval - interval
+
+    def due(self, now=None):
+        return (now if now is not None else time.monotonic()) >= self.nextframe
+
+    def wait(self, inputs=()):
+        """Sleep until the next frame is due or one of inputs (objects with fileno()) is readable
+
+        Returns the readable inputs, empty when the frame came due.
+        """
+        timeout = self.nextframe - time.monotonic()
+        if timeout <= 0:
+            return []
+
+        try:
+            readable, _, _ = select.select(inputs, [], [], timeout)
+        except (OSError, ValueError):
+            # An input closed under us, it is noticed when read; sleep out the frame
+            time.sleep(max(self.nextframe - time.monotonic(), 0))
+            return []
+
+        return readable
+
+    def startframe(self):
+        self._started = time.monotonic()
+
+    def endframe(self):
+        """Account the frame started by startframe() and schedule the next one"""
+        now = time.monotonic()
+        render = now - self._started
+        self.frames += 1
+        self.rendertime += render
+        self.worst = max(self.worst, render)
+
+        self.load += (render / self.period - self.load) * self.SMOOTHING
+        if not self.degraded and self.load > self.DEGRADEAT:
+            self.degraded = True
+            self.degradations += 1
+            logging.warning(f'Frames over budget ({render * 1000:.0f}ms of {self.period * 1000:.0f}ms), '
+                            f'dropping to {1 / self.degradedperiod:.0f}/s')
+        elif self.degraded and self.load < self.RECOVERAT:
+            self.degraded = False
+            logging.warning(f'Frames back in budget, rendering at {1 / self.period:.0f}/s')
+
+        # The first slot after this frame; the ones it ran into are skipped
+        slots = max(math.ceil(render / self.interval), 1)
+        if render > self.period:
+            self.overbudget += 1
+        self.skipped += slots - 1
+        self.nextframe = self._started + slots * self.interval
+
+        if self.statsperiod is not None and now - self._laststats >= self.statsperiod:
+            self._laststats = now
+            self.logstats()
+
+    def getstats(self):
+        elapsed = time.monotonic() - self._statsstart
+        return {
+            'fps': self.frames / elapsed if elapsed else 0,
+            'target_fps': 1 / self.period,
+            'frames': self.frames,
+            'render_ms': self.rendertime / self.frames * 1000 if self.frames else 0,
+            'worst_ms': self.worst * 1000,
+            'overbudget': self.overbudget,
+            'skipped': self.skipped,
+            'load': self.load,
+            'degraded': self.degraded,
+            'degradations': self.degradations,
+        }
+
+    def logstats(self):
+        stats = self.getstats()
+        logging.warning(f'Frames: {stats["fps"]:.1f}/s (target {stats["target_fps"]:.0f}), '
+                        f'render {stats["render_ms"]:.1f}ms avg {stats["worst_ms"]:.1f}ms worst, '
+                        f'{stats["overbudget"]} over budget, {stats["skipped"]} skipped, '
+                        f'degraded {stats["degradations"]} times')
+
+
+if __name__ == '__main__':
+    from threading import Thread
+
+    events = WakeQueue()
+    frames = FrameScheduler(fps=10, statsperiod=None)
+
+    def poster():
+        time.sleep(0.25)
+        events.put('key')
+
+    Thread(target=poster).start()
+
+    # Frames taking 30ms, then 150ms (over budget, degrades to 5/s), then 30ms again
+    started = time.monotonic()
+    for i in range(30):
+        woke = frames.wait([events])
+        pending = events.drain()
+        if not pending and not frames.due():
+            continue
+
+        frames.startframe()
+        print(f'{(time.monotonic() - started) * 1000:7.1f}ms {"input " + str(pending) if woke else "frame"}'
+              f'{" degraded" if frames.degraded else ""}')
+        time.sleep(0.15 if 8 <= i < 14 else 0.03)
+        frames.endframe()
+
+    print(frames.getstats())
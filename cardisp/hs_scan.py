@@ -1,17 +1,22 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
+import boottime  # first, so the boot report covers the imports below
 import os
 import pygame
 import time
-import random
 import logging
 import datetime
 from collections import deque
-from threading import Thread, Event
-from queue import Queue
+from threading import Event
 
 import config as gcfg
-from canreader import CanReader
+from canreader import CanReader, PerfTracker
+from sharedreader import SharedReaderView
+from asyncengine import AsyncEngine
+from tilebuffer import TileBuffer
+from textcache import textcache
+from framescheduler import FrameScheduler, WakeQueue
+from resources import pygamefont
 import canwriter
 from evdev import InputDevice, ecodes
 import gpiozero
@@ -21,12 +26,44 @@ logging.basicConfig(level=logging.WARNING, format='%(asctime)s - %(name)s - %(le
 canbus = os.getenv('CANBUS', 'vcan0')
 logging.warning(f'Running on CANBUS {canbus}')
 
-events = Queue()
+# dbc - pass every DBC message through the socket filter, display - only messages with displayed signals
+canfilter = os.getenv('CANFILTER', 'dbc')
+filtersignals = gcfg.displayedsignals() if canfilter == 'display' else None
+
+# Set DECODEALL=1 to decode every DBC signal, not just the displayed ones (for logging)
+decodeall = os.getenv('DECODEALL', '0') == '1'
+
+# thread - CAN ingest and OBD senders in this process, process - in a supervised child process
+ingest = os.getenv('INGEST', 'thread')
+logging.warning(f'CAN ingest running as a {ingest}')
+
+# threads - reader, OBD sender and keyboard threads, asyncio - all of them on one event loop
+engine = os.getenv('ENGINE', 'threads')
+logging.warning(f'Running the {engine} engine')
+
+# Input events for the display loop; the asyncio engine puts them from its thread, waking the loop
+events = WakeQueue()
+
+# Only graphed signals keep a history
+graphsignals = {sig for graphdef in gcfg.graphs for sig in graphdef.values()}
 
 isrunning = Event()
 isrunning.set()
-canreader = CanReader(canbus=canbus, dbc=gcfg.dbcfiles,
-                      isrunning=isrunning)
+
+# Built under __main__ by makereader(), so the ingest child process can import this module without one
+canreader = None
+
+
+def makereader():
+    """The CAN reader for the INGEST setting"""
+    if ingest == 'process':
+        return SharedReaderView(isrunning, canbus=canbus, dbc=gcfg.dbcfiles,
+                                filtersignals=filtersignals, decodeall=decodeall,
+                                historysignals=graphsignals)
+
+    return CanReader(canbus=canbus, dbc=gcfg.dbcfiles,
+                     isrunning=isrunning, filtersignals=filtersignals,
+                     decodeall=decodeall, historysignals=graphsignals)
 
 
 class HS_Scan(object):
@@ -64,9 +101,16 @@ class HS_Scan(object):
         self.screen = pygame.display.set_mode(self.size, pygame.FULLSCREEN)
         pygame.mouse.set_visible(False)
         pygame.font.init()
-        self.font1 = pygame.font.Font(gcfg.g_font, 40)
-        self.font2 = pygame.font.Font(gcfg.g_font, 96)
-        self.font3 = pygame.font.Font(gcfg.g_font, 20)
+        self.font1 = pygamefont(gcfg.g_font, 40)
+        self.font2 = pygamefont(gcfg.g_font, 96)
+        self.font3 = pygamefont(gcfg.g_font, 20)
+
+        self.layout = None
+        self.dirty = []
+        self.tiles = {}
+        self.regions = {}
+        self.header = None
+        self.buffers = {}
 
         self.displayimage(gcfg.g_bootimage)
 
@@ -82,27 +126,73 @@ class HS_Scan(object):
 
         pygame.display.update()
 
-    def updateKPIs(self, curscreen):
+    def beginframe(self, layout):
+        """Start a frame, repainting everything when the layout (screen being shown) changed
+
+        Tiles and text regions remember what they last showed (see blittile()); only the
+        ones that changed are redrawn and pushed to the display by endframe().
+        """
+        self.dirty = []
+        if layout == self.layout:
+            return
+
+        self.layout = layout
+        self.tiles = {}
+        self.regions = {}
+        self.header = None
         self.screen.fill(gcfg.g_black)
+        self.dirty.append(self.screen.get_rect())
+
+    def endframe(self):
+        if self.dirty:
+            # After a repaint the first rect is the whole screen
+            pygame.display.update(self.dirty[0] if self.dirty[0] == self.screen.get_rect() else self.dirty)
+
+    def blittile(self, pos, gauge, val):
+        """Render and blit a gauge tile unless it already shows the same state"""
+        key = (gauge, gauge.state(val))
+        tile = self.tiles.get(pos)
+        if tile is not None and tile[0] == key:
+            return
+
+        buffer = self.tilebuffer(pos, (gauge.gaugestyle.width, gauge.gaugestyle.height))
+        gauge.drawinto(val, buffer.image)
+        self.tiles[pos] = (key, buffer.surface)
+        self.dirty.append(self.screen.blit(buffer.surface, pos))
+
+    def tilebuffer(self, pos, size):
+        """The TileBuffer drawn into for a tile position, kept across frames and screens"""
+        buffer = self.buffers.get((pos, size))
+        if buffer is None:
+            buffer = self.buffers[(pos, size)] = TileBuffer(size)
+
+        return buffer
+
+    def region(self, name, rect, state):
+        """True (and rect cleared and marked dirty) if the region's state changed since the last frame"""
+        if self.regions.get(name) == state:
+            return False
+
+        self.regions[name] = state
+        self.dirty.append(self.screen.fill(gcfg.g_black, rect))
+
+        return True
+
+    def updateKPIs(self, curscreen):
+        self.beginframe(curscreen)
+        snapshot = canreader.snapshot
 
         for x in range(4):
             for y in range(2):
                 i = x + (4*y)
                 gauge = curscreen[i]
 
-                try:
-                    val = canreader.currentdata[gauge.name][-1][1]
-                except IndexError:
-                    val = None
-                except Exception:
-                    logging.exception('KPI conversion failed')
+                val = snapshot.current.get(gauge.name)
 
-                pilimage = gauge.gaugeclass.drawval(val)
-                raw_str = pilimage.tobytes("raw", 'RGB')
-                surface = pygame.image.fromstring(raw_str, pilimage.size, 'RGB')
-                self.screen.blit(surface, (x*320, y*360))
+                self.blittile((x*320, y*360), gauge.gaugeclass, val)
 
         self.drawheader()
+        self.endframe()
 
     def assemblegraphdata(self, graphdata):
         kpis = {}
@@ -112,109 +202,123 @@ class HS_Scan(object):
         return kpis
 
     def updategraph(self, graphdata):
-        self.screen.fill(gcfg.g_black)
+        self.beginframe(graphdata)
         kpis = self.assemblegraphdata(graphdata)
 
-        pilimage = gcfg.graphgauge.drawgraph(kpis)
-        raw_str = pilimage.tobytes("raw", 'RGBA')
-        surface = pygame.image.fromstring(raw_str, pilimage.size, 'RGBA')
+        surface = gcfg.graphgauge.drawsurface(kpis)
+        self.screen.fill(gcfg.g_black)
         self.screen.blit(surface, (0, 0))
 
         pygame.display.update()
 
     def perfscreen(self):
-        self.screen.fill(gcfg.g_black)
-        pt = canreader.perftracker
+        self.beginframe('perf')
+        snapshot = canreader.snapshot
+        pt = snapshot.perf
+
+        state = (pt.state, f'{pt.curr_et:0.2f}', f'{pt.distance:0.4f}',
+                 tuple(f'{perf}: {pt.current_result[perf]:0.2f}' for perf in pt.current_result),
+                 tuple(f'{perf}: {pt.last_result[perf]:0.2f}' for perf in pt.current_result))
 
-        textImage = self.font1.render(f'Current', True, gcfg.g_white)
-        self.screen.blit(textImage, (40, 0))
+        if self.region('perftext', (0, 0, 960, self.size[1]), state):
+            textImage = textcache.render(self.font1, f'Current', gcfg.g_white)
+            self.screen.blit(textImage, (40, 0))
 
-        textImage = self.font1.render(f'Last', True, gcfg.g_white)
-        self.screen.blit(textImage, (500, 0))
+            textImage = textcache.render(self.font1, f'Last', gcfg.g_white)
+            self.screen.blit(textImage, (500, 0))
 
-        y = 42
-        for perf in pt.current_result:
-            textImage = self.font1.render(f'{perf}: {pt.current_result[perf]:0.2f}',
-                                          True, gcfg.g_white)
-            self.screen.blit(textImage, (40, y))
-            textImage = self.font1.render(f'{perf}: {pt.results[-1][perf]:0.2f}',
-                                          True, gcfg.g_white)
-            self.screen.blit(textImage, (500, y))
-            y += 42
+            y = 42
+            for perf in pt.current_result:
+                textImage = textcache.render(self.font1, f'{perf}: {pt.current_result[perf]:0.2f}', gcfg.g_white)
+                self.screen.blit(textImage, (40, y))
+                textImage = textcache.render(self.font1, f'{perf}: {pt.last_result[perf]:0.2f}', gcfg.g_white)
+                self.screen.blit(textImage, (500, y))
+                y += 42
 
-        textImage = self.font2.render(f"ET: {pt.curr_et:0.2f}s", True, gcfg.g_white)
-        self.screen.blit(textImage, (40, 350))
+            textImage = textcache.render(self.font2, f"ET: {pt.curr_et:0.2f}s", gcfg.g_white)
+            self.screen.blit(textImage, (40, 350))
 
-        textImage = self.font2.render(f"Dist: {pt.distance:0.4f}mi", True, gcfg.g_white)
-        self.screen.blit(textImage, (40, 450))
+            textImage = textcache.render(self.font2, f"Dist: {pt.distance:0.4f}mi", gcfg.g_white)
+            self.screen.blit(textImage, (40, 450))
 
-        textImage = self.font2.render(f"{pt.PERFSTATES[pt.state]}", True, gcfg.g_white)
-        self.screen.blit(textImage, (40, 550))
+            textImage = textcache.render(self.font2, f"{PerfTracker.PERFSTATES[pt.state]}", gcfg.g_white)
+            self.screen.blit(textImage, (40, 550))
 
         # draw gauges
         for y in range(len(gcfg.perfgauges)):
                 gauge = gcfg.perfgauges[y]
-                try:
-                    val = canreader.currentdata[gauge.name][-1][1]
-                except Exception:
-                    val = None
+                val = snapshot.current.get(gauge.name)
 
-                pilimage = gauge.gaugeclass.drawval(val)
-                raw_str = pilimage.tobytes("raw", 'RGB')
-                surface = pygame.image.fromstring(raw_str, pilimage.size, 'RGB')
-                self.screen.blit(surface, (960, y * 360))
+                self.blittile((960, y * 360), gauge.gaugeclass, val)
 
-        pygame.display.update()
+        self.endframe()
 
     def meatball(self):
-        self.screen.fill(gcfg.g_black)
+        self.beginframe('meatball')
+        snapshot = canreader.snapshot
 
         try:
-            pilimage = gcfg.meatballgauge.drawmeatball(canreader.acceltracer.lat,
-                                                   canreader.acceltracer.accel,
-                                                   canreader.acceltracer.history)
+            if self.region('meatball', (320, 0, 640, self.size[1]), snapshot.accel):
+                style = gcfg.meatballgauge.style
+                buffer = self.tilebuffer((320, 0), (style.width, style.height))
+                gcfg.meatballgauge.drawmeatball(snapshot.accel.lat,
+                                                snapshot.accel.accel,
+                                                snapshot.accel.history,
+                                                buffer.image)
 
-
-            raw_str = pilimage.tobytes("raw", 'RGB')
-            surface = pygame.image.fromstring(raw_str, pilimage.size, 'RGB')
-            self.screen.blit(surface, (320, 0))
+                self.screen.blit(buffer.surface, (320, 0))
 
             quads = [(0, 0), (0, 360), (960, 0), (960, 360)]
 
             for i, gauge in enumerate(gcfg.meatballguages):
-                try:
-                    val = canreader.currentdata[gauge.name][-1][1]
-                except (KeyError, IndexError) as e:
-                    val = None
+                val = snapshot.current.get(gauge.name)
 
-                pilimage = gauge.gaugeclass.drawval(val)
-                raw_str = pilimage.tobytes("raw", 'RGB')
-                surface = pygame.image.fromstring(raw_str, pilimage.size, 'RGB')
-                self.screen.blit(surface, quads[i])
+                self.blittile(quads[i], gauge.gaugeclass, val)
 
-            pygame.display.update()
+            self.endframe()
 
         except:
             logging.exception('Meatball render fail..')
 
-
     def drawheader(self):
-        cpu = gpiozero.CPUTemperature()
-        loadaverage = gpiozero.LoadAverage(minutes=1)
+        """Draw the clock/CPU header over the top row of tiles, when it or a tile under it changed"""
+        headerrect = pygame.Rect(0, 0, self.size[0], self.font3.get_linesize())
         nowstring = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-        cputempstring = f'CPU Temp: {cpu.temperature:0.0f}C'
-        loadavgstring = f'CPU Load: {loadaverage.load_average:0.2f}'
 
-        textImage = self.font3.render(nowstring, True, gcfg.g_white)
+        if self.header is None or self.header[0] != nowstring:
+            cpu = gpiozero.CPUTemperature()
+            loadaverage = gpiozero.LoadAverage(minutes=1)
+            cputempstring = f'CPU Temp: {cpu.temperature:0.0f}C'
+            loadavgstring = f'CPU Load: {loadaverage.load_average:0.2f}'
+            header = (nowstring, cputempstring, loadavgstring)
+        else:
+            header = self.header
+
+        tilesunder = any(rect.colliderect(headerrect) for rect in self.dirty)
+        if header == self.header and not tilesunder:
+            return
+
+        # Put back the tile pixels under the header, so the text is drawn on clean tiles: header text
+        # left on a tile that wasn't redrawn would show through the new text or thicken the same text
+        self.screen.set_clip(headerrect)
+        self.screen.fill(gcfg.g_black)
+        for pos, (_, surface) in self.tiles.items():
+            self.screen.blit(surface, pos)
+        self.screen.set_clip(None)
+
+        self.header = header
+        nowstring, cputempstring, loadavgstring = header
+
+        textImage = textcache.render(self.font3, nowstring, gcfg.g_white)
         self.screen.blit(textImage, (0, 0))
 
-        textImage = self.font3.render(cputempstring, True, gcfg.g_white)
+        textImage = textcache.render(self.font3, cputempstring, gcfg.g_white)
         self.screen.blit(textImage, ((self.size[0] // 2) - (textImage.get_rect()[2] // 2), 0))
 
-        textImage = self.font3.render(loadavgstring, True, gcfg.g_white)
+        textImage = textcache.render(self.font3, loadavgstring, gcfg.g_white)
         self.screen.blit(textImage, (self.size[0] - textImage.get_rect()[2], 0))
 
-        pygame.display.update()
+        self.dirty.append(headerrect)
 
     def screenshot(self):
         tstamp = datetime.datetime.now().strftime('%Y%m%d%H%M%S')
@@ -222,23 +326,108 @@ class HS_Scan(object):
         pygame.image.save(self.screen, filename)
 
 
-def keyboardworker():
-    while isrunning.is_set():
+def bootreport():
+    """Log time from the first import to the first screen and the DBC database share of it"""
+    total = time.monotonic() - boottime.start
+    steps = {k: v for k, v in canreader.boottiming.items() if k != 'cachehit'}
+    dbtime = sum(steps.values())
+    details = ', '.join(f'{k} {v * 1000:.0f}ms' for k, v in steps.items())
+    cache = 'hit' if canreader.boottiming['cachehit'] else 'miss'
+
+    logging.warning(f'Boot: first screen after {total:.2f}s, DBC database {dbtime:.2f}s '
+                    f'({dbtime / total:.0%}, cache {cache}: {details})')
+
+
+def subscribedisplay(mode, gaugescreen, graph, obdrates=None):
+    """Point the reader's 'screen' subscription and the OBD poll rates at the signals visible in the current mode"""
+    if mode == 0:
+        names = [gauge.name for gauge in gaugescreen]
+    elif mode == 1:
+        names = [gauge.name for gauge in gcfg.perfgauges + gcfg.meatballguages]
+    else:
+        names = graph.values()
+
+    canreader.subscribe('screen', names)
+    if obdrates is not None:
+        obdrates.setvisible(names)
+
+
+class KeyboardInput(object):
+    """The evdev keyboard, read from the display loop instead of its own thread
+
+    The open device's fd goes into FrameScheduler.wait(), so a key press wakes the loop
+    at once. A missing or lost device is tried again every retryperiod seconds.
+    """
+
+    def __init__(self, path='/dev/input/event1', retryperiod=1):
+        self.path = path
+        self.retryperiod = retryperiod
+        self.dev = None
+        self._retryat = 0
+
+    def fileno(self):
+        return self.dev.fd
+
+    def open(self, now):
+        """True if the device is open, opening and grabbing it first when a retry is due"""
+        if self.dev is None and now >= self._retryat:
+            try:
+                dev = InputDevice(self.path)
+            except OSError:
+                logging.info('Waiting for input device')
+                self._retryat = now + self.retryperiod
+                return False
+
+            try:
+                dev.grab()
+            except OSError:
+                logging.warning(f'Could not grab {self.path}')
+                dev.close()
+                self._retryat = now + self.retryperiod
+                return False
+
+            self.dev = dev
+
+        return self.dev is not None
+
+    def read(self):
+        """Events waiting on the device, without blocking"""
+        if self.dev is None:
+            return []
+
+        try:
+            return list(self.dev.read())
+        except BlockingIOError:
+            return []
+        except OSError:
+            logging.warning(f'Lost input device {self.path}')
+            self.close()
+            return []
+
+    def close(self):
+        if self.dev is None:
+            return
+
         try:
-            dev = InputDevice('/dev/input/event1')
-            dev.grab()
-            for event in dev.read_loop():
-                events.put(event)
-        except Exception:
-            logging.info('Waiting for input device')
-            time.sleep(0.1)
-    dev.ungrab()
+            self.dev.ungrab()
+        except OSError:
+            pass
+        self.dev.close()
+        self.dev = None
+        self._retryat = time.monotonic() + self.retryperiod
 
 
 if __name__ == '__main__':
     # Start screen and reader
+    canreader = makereader()
     scanner = HS_Scan()
-    canreader.start()
+    # The asyncio engine drives an in-process reader itself, a process reader always has its own child
+    readerthread = engine != 'asyncio' or ingest == 'process'
+    if readerthread:
+        canreader.start()
+    if engine == 'asyncio':
+        asyncengine = AsyncEngine(None if readerthread else canreader, events=events, isrunning=isrunning)
+        asyncengine.start()
 
     perfscreens = deque([scanner.meatball, scanner.perfscreen])
     perfscreen = perfscreens[0]
@@ -249,27 +438,51 @@ if __name__ == '__main__':
     graphs = deque(gcfg.graphs)
     graph = graphs[0]
 
+    graphzooms = deque(gcfg.graphgauge.ZOOMS)
+    graphzooms.rotate(-graphzooms.index(gcfg.graphgauge.window))
+
     modes = deque([0, 1, 2])
     mode = modes[0]
 
-    # Start can senders
-    logging.warning('Starting OBD senders')
-    writers = []
-    for pid in canwriter.sendpids:
-        writer = canwriter.CanWriter(canbus=canbus, pid=pid, isrunning=isrunning)
-        writer.start()
-        writers.append(writer)
+    obdscheduler = None
+    keyboard = None
+    if engine != 'asyncio':
+        if ingest == 'thread':
+            logging.warning('Starting OBD scheduler')
+            obdscheduler = canwriter.OBDScheduler(canbus, isrunning=isrunning)
+            canreader.responsehandler = obdscheduler.onresponse
+            obdscheduler.start()
+
+        # The asyncio engine reads input itself and puts it on events
+        keyboard = KeyboardInput()
+
+    # Whichever scheduler sends the OBD requests: the child's (via the view), the engine's or ours
+    if ingest == 'process':
+        obdrates = canreader
+    elif engine == 'asyncio':
+        obdrates = asyncengine.scheduler
+    else:
+        obdrates = obdscheduler
+
+    # Graphs need history before they are shown, so keep all graphed signals decoding.
+    canreader.subscribe('graphs', graphsignals)
+    subscribedisplay(mode, gaugescreen, graph, obdrates)
+
+    frames = FrameScheduler(gcfg.framerates[mode], gcfg.degradedframerates[mode])
+    firstframe = True
+    while True:
+        try:
+            inputs = [events]
+            if keyboard is not None and keyboard.open(time.monotonic()):
+                inputs.append(keyboard)
 
-        time.sleep(random.random())
+            frames.wait(inputs)
 
-    logging.warning('Starting keybord reader')
-    keyboard = Thread(target=keyboardworker)
-    keyboard.start()
+            pending = events.drain()
+            if keyboard is not None:
+                pending += keyboard.read()
 
-    while True:
-        try:
-            if not events.empty():
-                event = events.get_nowait()
+            for event in pending:
                 logging.warning(event)
                 if event.type == 1 and event.value == 1:
                     if event.code == gcfg.g_screenup:
@@ -297,26 +510,51 @@ if __name__ == '__main__':
                         modes.rotate(1)
                         mode = modes[0]
 
+                    subscribedisplay(mode, gaugescreen, graph, obdrates)
+
                     if event.code == gcfg.g_screenshot:
                         scanner.screenshot()
 
-            time.sleep(0.05)
+                    if event.code == gcfg.g_graphzoom and mode == 2:
+                        graphzooms.rotate(-1)
+                        gcfg.graphgauge.window = graphzooms[0]
+
+            frames.setfps(gcfg.framerates[mode], gcfg.degradedframerates[mode])
+
+            # A key press is answered with a frame straight away, otherwise frames go out at the mode's rate
+            # (releases, repeats and sync events change nothing on screen)
+            pressed = any(event.type == 1 and event.value == 1 for event in pending)
+            if not pressed and not frames.due():
+                continue
+
+            frames.startframe()
             if mode == 0:
                 scanner.updateKPIs(gaugescreen)
             elif mode == 1:
                 perfscreen()
             elif mode == 2:
                 scanner.updategraph(graph)
+            frames.endframe()
+
+            if firstframe:
+                bootreport()
+                firstframe = False
 
         except KeyboardInterrupt:
             isrunning.clear()
             break
 
-    keyboard.join()
-    canreader.join()
+    frames.logstats()
+    logging.warning(f'Text cache: {textcache.stats()}')
+
+    if keyboard is not None:
+        keyboard.close()
+    if engine == 'asyncio':
+        asyncengine.join()
+    if readerthread:
+        canreader.join()
 
-    # Shut down writers.
-    for writer in writers:
-        writer.join()
+    if obdscheduler is not None:
+        obdscheduler.join()
 
     exit(0)
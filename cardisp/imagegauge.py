@@ -2,7 +2,10 @@
 # -*- coding: utf-8 -*-
 import logging
 from collections import namedtuple
-from PIL import Image, ImageDraw, ImageFont
+from PIL import Image, ImageDraw
+
+from textcache import textcache
+from resources import truetype, shared
 
 ImageGaugeStyle = namedtuple('ImageGaugeStyle', ['width', 'height', 'bgcolor', 'alertcolor',
                                                  'barcolor', 'barbgcolor', 'sweepstart',
@@ -14,19 +17,51 @@ ImageGaugeConfig = namedtuple('ImageGaugeConfig', ['displayname', 'unit', 'altun
                                                    'max', 'alertval', 'alertvallow', 'fmtstring'])
 
 
+# Static layers per (style, config, background colour), shared by gauges with the same definition
+_layercache = {}
+
+# Sweep masks per sweep geometry, {(start, end): (box, mask)}, shared by every style with that geometry
+_sweepatlas = {}
+
+
 class ImageGauge(object):
+    """Gauge image of one value
+
+    The parts that don't depend on the value - background, sweep track, centre and label - are
+    rendered once per (style, config, alert background) into layers (see _layers()), so drawval()
+    only copies the base layer, pastes the value sweep, pastes the centre and label back over it
+    and draws the value text. prerender=False draws everything every frame, as before.
+
+    Values whose sweep leaves the track (above max or below min) are drawn in full, as before:
+    their sweep reaches round under the label, which has to be drawn over it.
+
+    The value sweep is a bar colour fill through a 1 bit mask from the sweep atlas, built lazily
+    per integer angle between sweepstart and sweepend and shared by all styles of the same
+    geometry (see _sweepmask()), instead of a pieslice rasterized every frame.
+    """
     NOSWEEP = 0
     STD = 1
     DELTA = 2
     BOOL = 3
     TEXT = 4
 
-    def __init__(self, gaugestyle, gaugeconfig):
+    def __init__(self, gaugestyle, gaugeconfig, prerender=True):
         self.gaugestyle = gaugestyle
         self.gaugeconfig = gaugeconfig
-        self.fonttext = ImageFont.truetype(self.gaugestyle.font, size=24)
-        self.fontsmall = ImageFont.truetype(self.gaugestyle.font, size=32)
-        self.fontlarge = ImageFont.truetype(self.gaugestyle.font, size=110)
+        self.prerender = prerender
+
+    # Fonts come from the shared pool on first draw, so building a gauge loads nothing
+    @property
+    def fonttext(self):
+        return truetype(self.gaugestyle.font, 24)
+
+    @property
+    def fontsmall(self):
+        return truetype(self.gaugestyle.font, 32)
+
+    @property
+    def fontlarge(self):
+        return truetype(self.gaugestyle.font, 110)
 
     def _valtext(self, value):
         try:
@@ -43,10 +78,7 @@ class ImageGauge(object):
             logging.info('Value Format failed.')
             return '---'
 
-    def drawval(self, value):
-        # cenx = self.gaugestyle.width/2
-        ceny = self.gaugestyle.height/2
-
+    def _bgcolor(self, value):
         bgcol = self.gaugestyle.bgcolor
 
         try:
@@ -61,6 +93,126 @@ class ImageGauge(object):
         except Exception:
             logging.info('No val - using default BG')
 
+        return bgcol
+
+    def _hassweep(self):
+        return self.gaugestyle.sweeptype in (ImageGauge.STD, ImageGauge.DELTA)
+
+    def _layers(self, bgcol, mode='RGB'):
+        """(base, face, facemask) for a background colour and image mode, rendered on first use
+
+        base - background, sweep track and label
+        face - base with the centre cut out of the track and the label redrawn over it
+        facemask - where face covers the value sweep (centre and label pixels), None without a sweep
+        """
+        key = (self.gaugestyle, self.gaugeconfig, bgcol, mode)
+        layers = _layercache.get(key)
+        if layers is not None:
+            return layers
+
+        if mode != 'RGB':
+            base, face, facemask = self._layers(bgcol)
+            layers = _layercache[key] = (base.convert(mode),
+                                         face.convert(mode) if face is not None else None,
+                                         facemask)
+            return layers
+
+        size = (self.gaugestyle.width, self.gaugestyle.height)
+        track = Image.new('RGB', size, bgcol)
+        if self._hassweep():
+            self._drawtrack(ImageDraw.Draw(track))
+
+        base = track.copy()
+        self._drawlabel(ImageDraw.Draw(base), self.gaugestyle.textcolor)
+
+        face = facemask = None
+        if self._hassweep():
+            face = track
+            draw = ImageDraw.Draw(face)
+            self._drawcenter(draw, bgcol)
+            self._drawlabel(draw, self.gaugestyle.textcolor)
+            del draw
+
+            facemask = Image.new('L', size, 0)
+            draw = ImageDraw.Draw(facemask)
+            self._drawcenter(draw, 255)
+            self._drawlabel(draw, 255)
+            del draw
+
+        if self.gaugestyle.sweeptype != ImageGauge.TEXT:
+            # Values are numbers: compose them from digit glyphs rather than rasterize each new one
+            textcache.prewarm(self.fontlarge)
+
+        layers = _layercache[key] = (base, face, facemask)
+
+        return layers
+
+    def _layered(self, value):
+        """True if value can be drawn over the layers: no sweep, or one that stays on the track"""
+        if not self._hassweep():
+            return True
+
+        try:
+            start, end = self._sweepangles(value)
+        except Exception:
+            return True
+
+        lowest, highest = self.gaugestyle.sweepstart, self.gaugestyle.sweepend + 1
+
+        return lowest <= start <= highest and lowest <= end <= highest
+
+    def state(self, value):
+        """What drawval(value) shows: (value text, sweep angles, background). Equal states draw equal images."""
+        angles = None
+        if self._hassweep():
+            try:
+                angles = self._sweepangles(value)
+            except Exception:
+                pass
+
+        return self._valtext(value), angles, self._bgcolor(value)
+
+    def drawval(self, value):
+        bgcol = self._bgcolor(value)
+        if not self.prerender or not self._layered(value):
+            return self._drawfull(value, bgcol)
+
+        base, face, facemask = self._layers(bgcol)
+
+        im = base.copy()
+        self._drawover(im, value, face, facemask)
+
+        return im
+
+    def drawinto(self, value, im):
+        """Draw value into im in place (a gauge sized image of any mode, e.g. TileBuffer.image)
+
+        Same pixels as drawval(), without allocating an image per frame.
+        """
+        bgcol = self._bgcolor(value)
+        if not self.prerender or not self._layered(value):
+            im.paste(self._drawfull(value, bgcol))
+            return im
+
+        base, face, facemask = self._layers(bgcol, im.mode)
+
+        im.paste(base)
+        self._drawover(im, value, face, facemask)
+
+        return im
+
+    def _drawover(self, im, value, face, facemask):
+        """Value sweep and text over the base layer in im"""
+        if face is not None:
+            self._pastesweep(im, value)
+            im.paste(face, (0, 0), facemask)
+
+        draw = ImageDraw.Draw(im)
+        self._drawvalue(draw, value)
+
+        del draw
+
+    def _drawfull(self, value, bgcol):
         im = Image.new('RGB', (self.gaugestyle.width, self.gaugestyle.height), bgcol)
         draw = ImageDraw.Draw(im)
 
@@ -71,39 +223,50 @@ class ImageGauge(object):
         elif self.gaugestyle.sweeptype == ImageGauge.BOOL:
             draw = self.drawbool(value, draw, bgcol)
 
+        self._drawlabel(draw, self.gaugestyle.textcolor)
+        self._drawvalue(draw, value)
+
+        del draw
+
+        return im
+
+    def _drawlabel(self, draw, fill):
         if self.gaugeconfig.unit is not None:
             text = f"{self.gaugeconfig.displayname}: {self.gaugeconfig.unit}"
         else:
             text = f"{self.gaugeconfig.displayname}"
 
-        valtext = self._valtext(value)
-
-        if self.gaugestyle.sweeptype == ImageGauge.TEXT:
-            tf = self.fontsmall
-        else:
-            tf = self.fontlarge
-
         fontbox1 = draw.textsize(text, font=self.fontsmall)
-        fontbox2 = draw.textsize(valtext, font=tf)
 
         draw.text((self.gaugestyle.width / 2-(fontbox1[0]/2),
                    self.gaugestyle.height-fontbox1[1] - self.gaugestyle.gutter),
                   text,
-                  fill=self.gaugestyle.textcolor,
+                  fill=fill,
                   font=self.fontsmall)
 
-        draw.text((self.gaugestyle.width / 2-(fontbox2[0]/2),
-                   ceny - fontbox2[1]/2),
-                  valtext,
-                  fill=self.gaugestyle.textcolor,
-                  font=tf)
+    def _drawvalue(self, draw, value):
+        ceny = self.gaugestyle.height/2
+        valtext = self._valtext(value)
 
-        del draw
+        if self.gaugestyle.sweeptype == ImageGauge.TEXT:
+            tf = self.fontsmall
+        else:
+            tf = self.fontlarge
 
-        return im
+        fontbox2 = textcache.textsize(tf, valtext)
 
-    def drawstandardsweep(self, value, draw, bgcolor):
-        goff = (self.gaugestyle.height-(2 * self.gaugestyle.gutter)) / 4 - 2 * self.gaugestyle.gutter
+        textcache.text(draw,
+                       (self.gaugestyle.width / 2-(fontbox2[0]/2),
+                        ceny - fontbox2[1]/2),
+                       valtext,
+                       self.gaugestyle.textcolor,
+                       tf)
+
+    def _goff(self):
+        return (self.gaugestyle.height-(2 * self.gaugestyle.gutter)) / 4 - 2 * self.gaugestyle.gutter
+
+    def _drawtrack(self, draw):
+        goff = self._goff()
 
         draw.pieslice((self.gaugestyle.gutter,
                        self.gaugestyle.gutter + goff,
@@ -115,73 +278,103 @@ class ImageGauge(object):
                       outline=self.gaugestyle.outlinecolor,
                       width=self.gaugestyle.outline)
 
-        try:
-            valscale = (value - self.gaugeconfig.min) / (self.gaugeconfig.max - self.gaugeconfig.min)
+    def _sweepangles(self, value):
+        """(start, end) of the value sweep, raises for values that can't be drawn"""
+        if self.gaugestyle.sweeptype == ImageGauge.DELTA:
+            sweepmidpoint = (self.gaugestyle.sweepend + self.gaugestyle.sweepstart) / 2
+            valscale = (value - (self.gaugeconfig.max + self.gaugeconfig.min)/2)
+            valscale /= (self.gaugeconfig.max - self.gaugeconfig.min)
             barscale = (self.gaugestyle.sweepend - self.gaugestyle.sweepstart)
-            valbar = 1 + int((valscale * barscale) + self.gaugestyle.sweepstart)
-            draw.pieslice((self.gaugestyle.gutter + self.gaugestyle.outline,
-                           self.gaugestyle.gutter + self.gaugestyle.outline + goff,
-                           self.gaugestyle.width - self.gaugestyle.gutter - self.gaugestyle.outline,
-                           self.gaugestyle.width - self.gaugestyle.gutter - self.gaugestyle.outline + goff),
-                          self.gaugestyle.sweepstart + 1,
-                          valbar,
+            valbar = int((valscale * barscale) + sweepmidpoint)
+
+            return min(valbar, sweepmidpoint), max(valbar, sweepmidpoint)
+
+        valscale = (value - self.gaugeconfig.min) / (self.gaugeconfig.max - self.gaugeconfig.min)
+        barscale = (self.gaugestyle.sweepend - self.gaugestyle.sweepstart)
+        valbar = 1 + int((valscale * barscale) + self.gaugestyle.sweepstart)
+
+        return self.gaugestyle.sweepstart + 1, valbar
+
+    def _sweepbox(self):
+        goff = self._goff()
+
+        return (self.gaugestyle.gutter + self.gaugestyle.outline,
+                self.gaugestyle.gutter + self.gaugestyle.outline + goff,
+                self.gaugestyle.width - self.gaugestyle.gutter - self.gaugestyle.outline,
+                self.gaugestyle.width - self.gaugestyle.gutter - self.gaugestyle.outline + goff)
+
+    def _drawsweep(self, draw, value):
+        try:
+            start, end = self._sweepangles(value)
+            draw.pieslice(self._sweepbox(),
+                          start,
+                          end,
                           fill=self.gaugestyle.barcolor,
                           outline=None)
         except Exception:
             logging.info('Value sweep not drawable')
 
-        draw.ellipse((self.gaugestyle.sweepthick + self.gaugestyle.gutter,
-                      self.gaugestyle.sweepthick + self.gaugestyle.gutter + goff,
-                      self.gaugestyle.width - self.gaugestyle.gutter - self.gaugestyle.sweepthick,
-                      self.gaugestyle.width - self.gaugestyle.gutter - self.gaugestyle.sweepthick + goff),
-                     fill=bgcolor,
-                     outline=None)
-
-        return draw
+    def _sweepmask(self, start, end):
+        """(box, mask) of the sweep pieslice from the atlas, None if there is nothing to draw"""
+        style = self.gaugestyle
+        geometry = (style.width, style.height, style.gutter, style.outline, style.sweepstart, style.sweepend)
+        atlas = _sweepatlas.setdefault(geometry, {})
 
-    def drawabssweep(self, value, draw, bgcolor):
-        goff = (self.gaugestyle.height-(2 * self.gaugestyle.gutter)) / 4 - 2 * self.gaugestyle.gutter
-        sweepmidpoint = (self.gaugestyle.sweepend + self.gaugestyle.sweepstart) / 2
+        key = (start, end)
+        if key not in atlas:
+            mask = Image.new('1', (style.width, style.height), 0)
+            ImageDraw.Draw(mask).pieslice(self._sweepbox(), start, end, fill=1, outline=None)
+            box = mask.getbbox()
+            atlas[key] = (box, mask.crop(box)) if box else None
 
-        draw.pieslice((self.gaugestyle.gutter,
-                       self.gaugestyle.gutter + goff,
-                       self.gaugestyle.width - self.gaugestyle.gutter,
-                       self.gaugestyle.width - self.gaugestyle.gutter + goff),
-                      self.gaugestyle.sweepstart,
-                      self.gaugestyle.sweepend,
-                      fill=self.gaugestyle.barbgcolor,
-                      outline=self.gaugestyle.outlinecolor,
-                      width=self.gaugestyle.outline)
+        return atlas[key]
 
+    def _pastesweep(self, im, value):
+        """Value sweep from the atlas; only for values _layered() accepts, so the atlas stays bounded"""
         try:
-            valscale = (value - (self.gaugeconfig.max + self.gaugeconfig.min)/2)
-            valscale /= (self.gaugeconfig.max - self.gaugeconfig.min)
-            barscale = (self.gaugestyle.sweepend - self.gaugestyle.sweepstart)
-            valbar = int((valscale * barscale) + sweepmidpoint)
-            draw.pieslice((self.gaugestyle.gutter + self.gaugestyle.outline,
-                           self.gaugestyle.gutter + self.gaugestyle.outline + goff,
-                           self.gaugestyle.width - self.gaugestyle.gutter - self.gaugestyle.outline,
-                           self.gaugestyle.width - self.gaugestyle.gutter - self.gaugestyle.outline + goff),
-                          min(valbar, sweepmidpoint),
-                          max(valbar, sweepmidpoint),
-                          fill=self.gaugestyle.barcolor,
-                          outline=None)
+            start, end = self._sweepangles(value)
         except Exception:
             logging.info('Value sweep not drawable')
+            return
+
+        entry = self._sweepmask(start, end)
+        if entry is not None:
+            box, mask = entry
+            im.paste(self.gaugestyle.barcolor, box, mask)
+
+    def _drawcenter(self, draw, fill):
+        goff = self._goff()
 
         draw.ellipse((self.gaugestyle.sweepthick + self.gaugestyle.gutter,
                       self.gaugestyle.sweepthick + self.gaugestyle.gutter + goff,
                       self.gaugestyle.width - self.gaugestyle.gutter - self.gaugestyle.sweepthick,
                       self.gaugestyle.width - self.gaugestyle.gutter - self.gaugestyle.sweepthick + goff),
-                     fill=bgcolor,
+                     fill=fill,
                      outline=None)
 
+    def drawstandardsweep(self, value, draw, bgcolor):
+        self._drawtrack(draw)
+        self._drawsweep(draw, value)
+        self._drawcenter(draw, bgcolor)
+
+        return draw
+
+    def drawabssweep(self, value, draw, bgcolor):
+        self._drawtrack(draw)
+        self._drawsweep(draw, value)
+        self._drawcenter(draw, bgcolor)
+
         return draw
 
     def drawbool(self, value, draw, bgcolor):
         return draw
 
 
+def gauge(gaugestyle, gaugeconfig):
+    """The ImageGauge for a style and config, one instance shared by every screen showing it"""
+    return shared(ImageGauge, gaugestyle, gaugeconfig)
+
+
 if __name__ == '__main__':
     teststyle = ImageGaugeStyle(width=320, height=360, bgcolor="#000000", alertcolor="#f0b01d",
                                 barcolor="#0000FF", barbgcolor="#222222", sweepstart=140, sweepend=400,
@@ -1,101 +1,185 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
-from collections import deque
-import datetime
 import logging
 from PIL import Image
+import pygame
 import numpy as np
 import matplotlib.pyplot as plt
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.collections import PolyCollection
+
+from timeseries import TieredHistory
+from stripchart import fitlimits
+
+
+class GraphFigure(object):
+    """One persistent figure for a graph definition, updated in place every frame
+
+    The axes, grid, ticks and labels are rendered once into a background that is restored
+    each frame (Agg blitting); only the traces and the legend over them are drawn again,
+    after set_data()/set_verts() with the new history. A full draw happens only when the
+    axis limits have to change.
+
+    names - trace labels in legend order (the keys of the kpis given to update())
+    """
+    # Limits get this much headroom past the data when they have to change, and shrink back
+    # only when the data uses less than SHRINK of them, so a climbing trace doesn't redraw
+    # the axes every frame
+    HEADROOM = 0.25
+    SHRINK = 0.5
+
+    def __init__(self, names, graphstyle):
+        plt.style.use(graphstyle)
+        plt.rcParams.update({'font.size': 18})
+
+        self.names = names
+        self.fig = Figure(figsize=(12.8, 7.2))
+        self.canvas = FigureCanvasAgg(self.fig)
+        self.ax = self.fig.add_subplot()
+
+        self.lines = []
+        self.fills = []
+        for name in names:
+            line, = self.ax.plot([], [], animated=True)
+            fill = PolyCollection([], facecolor=line.get_color(), alpha=0.3, linewidth=0, animated=True)
+            self.ax.add_collection(fill, autolim=False)
+            self.lines.append(line)
+            self.fills.append(fill)
+
+        self.ax.set_xlabel('Rel Time(s)')
+        self.ax.grid(color='#333333')
+        self.legend = self.fig.legend(self.lines, names, loc='upper left', ncol=4, mode="expand")
+        self.legend.set_animated(True)
+
+        self.background = None
+
+    def update(self, traces, window):
+        """Draw traces, [(x, mins, maxs, means)] in names order, with window seconds shown (None for all)"""
+        span = window or 1
+        low, high = np.inf, -np.inf
+        for (x, mins, maxs, means), line, fill in zip(traces, self.lines, self.fills):
+            line.set_data(x, means)
+            if len(x) and (mins is not maxs):
+                fill.set_verts([np.column_stack((np.concatenate((x, x[::-1])),
+                                                 np.concatenate((maxs, mins[::-1]))))])
+                low, high = min(low, np.nanmin(mins)), max(high, np.nanmax(maxs))
+            else:
+                fill.set_verts([])
+                if len(x):
+                    low, high = min(low, np.nanmin(means)), max(high, np.nanmax(means))
+            if window is None and len(x):
+                span = max(span, -x[0])
+
+        xlim = self._xlim(span, window)
+        ylim = self._ylim(low, high)
+        if self.background is None or xlim != self.ax.get_xlim() or ylim != self.ax.get_ylim():
+            self.ax.set_xlim(xlim)
+            self.ax.set_ylim(ylim)
+            # Animated artists are left out of a full draw, which leaves the background
+            self.canvas.draw()
+            self.background = self.canvas.copy_from_bbox(self.fig.bbox)
+        else:
+            self.canvas.restore_region(self.background)
+
+        for fill, line in zip(self.fills, self.lines):
+            self.ax.draw_artist(fill)
+            self.ax.draw_artist(line)
+        self.fig.draw_artist(self.legend)
+
+        return self.canvas.buffer_rgba(), self.canvas.get_width_height()
+
+    def _xlim(self, span, window):
+        if window is not None:
+            return (-window, 0)
+
+        # Whole drive: grow in steps rather than every frame
+        shown = -self.ax.get_xlim()[0] if self.background is not None else 0
+        if span > shown:
+            shown = span * (1 + self.HEADROOM)
+
+        return (-shown, 0)
+
+    def _ylim(self, low, high):
+        shown = self.ax.get_ylim() if self.background is not None else None
+        return fitlimits(low, high, shown, self.HEADROOM, self.SHRINK)
 
 
 class ImageGraph(object):
-    def __init__(self, graphstyle='dark_background'):
+    """Matplotlib trend graph of TieredHistory signals
+
+    window - seconds of history shown, None for the whole drive
+    maxpoints - upper bound of points per trace, see TieredHistory.window()
+
+    Each set of signals graphed (each config.graphs definition) keeps its GraphFigure, so a frame
+    only updates the traces of an existing figure.
+    """
+    ZOOMS = [10, 30, 120, 600, 1800, None]
+
+    def __init__(self, graphstyle='dark_background', window=120, maxpoints=1000):
         self.graphstyle = graphstyle
+        self.window = window
+        self.maxpoints = maxpoints
+        self.figures = {}
 
     def formatdata(self, kpi):
-        x = []
-        y = []
+        """Relative times, bucket mins, maxs and means of the graph window from a TieredHistory"""
+        x = mins = maxs = means = []
 
         try:
-            data = list(kpi)
-            x, y = zip(*data)
-            x = [(xp-x[-1]).total_seconds() for xp in x]
+            times, mins, maxs, means = kpi.window(self.window, self.maxpoints)
+            if len(times):
+                x = times - kpi.lasttime
         except Exception:
             logging.info('Data formatting failed')
 
-        return x, y
+        return x, mins, maxs, means
 
     def drawgraph(self, kpis: dict):
+        """PIL RGBA image of the graph, over the figure's own pixels (no copy)"""
         try:
-            plt.style.use(self.graphstyle)
-            plt.rcParams.update({'font.size': 18})
-
-            fig, ax = plt.subplots()
-            fig.set_size_inches(12.8, 7.2)
-            # fig.suptitle(', '.join(kpis.keys()), fontsize=16)
-
-            for kpi in kpis:
-                x, y = self.formatdata(kpis[kpi])
-                ax.plot(x, y)
-                ax.set_xlabel('Rel Time(s)')
-                ax.grid(color='#333333')
-                ax.set_xlim([-120, 0])
-
-            fig.legend(kpis.keys(), loc='upper left', ncol=4, mode="expand")
-
-            im = self._fig2img(fig)
-            plt.close()
-
-            return im
-
+            buf, size = self.drawbuffer(kpis)
+            return Image.frombuffer('RGBA', size, buf, 'raw', 'RGBA', 0, 1)
         except Exception:
-            pass
-
-    def _fig2data(self,  fig):
-        """
-        @brief Convert a Matplotlib figure to a 4D numpy array with RGBA channels and return it
-        @param fig a matplotlib figure
-        @return a numpy 3D array of RGBA values
-        """
-        # draw the renderer
-        fig.canvas.draw()
+            logging.exception('Graph Image Creation Failed')
 
-        # Get the RGBA buffer from the figure
-        w, h = fig.canvas.get_width_height()
-        buf = np.frombuffer(fig.canvas.tostring_argb(), dtype=np.uint8)
-        buf.shape = (w, h, 4)
+    def drawsurface(self, kpis: dict):
+        """pygame surface over drawbuffer(), read as RGBX (the figure is opaque) to blit without blending"""
+        buf, size = self.drawbuffer(kpis)
+        return pygame.image.frombuffer(buf, size, 'RGBX')
 
-        # canvas.tostring_argb give pixmap in ARGB mode. Roll the ALPHA channel to have it in RGBA mode
-        buf = np.roll(buf, 3, axis=2)
-        return buf
+    def drawbuffer(self, kpis: dict):
+        """(RGBA pixel buffer, (width, height)) of the graph, for pygame.image.frombuffer()
 
-    def _fig2img(self, fig):
+        The buffer is the figure's Agg renderer memory, so nothing is copied or converted. It is
+        drawn over by the next call for the same signals.
         """
-        @brief Convert a Matplotlib figure to a PIL Image in RGBA format and return it
-        @param fig a matplotlib figure
-        @return a Python Imaging Library ( PIL ) image
-        http://www.icare.univ-lille1.fr/tutorials/convert_a_matplotlib_figure
-        """
-        # put the figure pixmap into a numpy array
-        buf = self._fig2data(fig)
-        w, h, d = buf.shape
-
-        try:
-            im = Image.frombuffer("RGBA", (w, h), buf.tostring(), 'raw', "RGBA", 0, 1)
-        except Exception:
-            logging.exception('Graph Image Creation Failed')
+        names = tuple(kpis)
+        figure = self.figures.get(names)
+        if figure is None:
+            figure = self.figures[names] = GraphFigure(names, self.graphstyle)
 
-        return im
+        return figure.update([self.formatdata(kpis[name]) for name in names], self.window)
 
 
 if __name__ == '__main__':
     data = {
-        'speed_average_non_driven': deque([(datetime.datetime(2020, 2, 28, 9, 42, 11, 296388), 55.625), (datetime.datetime(2020, 2, 28, 9, 42, 11, 333536), 55.59375), (datetime.datetime(2020, 2, 28, 9, 42, 11, 370685), 55.75), (datetime.datetime(2020, 2, 28, 9, 42, 11, 460411), 55.71875), (datetime.datetime(2020, 2, 28, 9, 42, 11, 560487), 55.8125), (datetime.datetime(2020, 2, 28, 9, 42, 11, 660135), 55.921875), (datetime.datetime(2020, 2, 28, 9, 42, 11, 759670), 55.875), (datetime.datetime(2020, 2, 28, 9, 42, 11, 859974), 55.90625), (datetime.datetime(2020, 2, 28, 9, 42, 11, 965114), 55.9375), (datetime.datetime(2020, 2, 28, 9, 42, 12, 59960), 55.9375), (datetime.datetime(2020, 2, 28, 9, 42, 12, 159938), 55.90625), (datetime.datetime(2020, 2, 28, 9, 42, 12, 259230), 55.921875), (datetime.datetime(2020, 2, 28, 9, 42, 12, 359954), 56.109375), (datetime.datetime(2020, 2, 28, 9, 42, 12, 459700), 56.109375), (datetime.datetime(2020, 2, 28, 9, 42, 12, 560140), 55.921875), (datetime.datetime(2020, 2, 28, 9, 42, 12, 659736), 56.0625), (datetime.datetime(2020, 2, 28, 9, 42, 12, 765568), 56.140625), (datetime.datetime(2020, 2, 28, 9, 42, 12, 859687), 56.046875), (datetime.datetime(2020, 2, 28, 9, 42, 12, 959702), 55.984375), (datetime.datetime(2020, 2, 28, 9, 42, 13, 59806), 56.046875), (datetime.datetime(2020, 2, 28, 9, 42, 13, 159686), 55.84375), (datetime.datetime(2020, 2, 28, 9, 42, 13, 259668), 55.828125)], maxlen=2000),
-        'throttle_position': deque([(datetime.datetime(2020, 2, 28, 9, 42, 11, 295581), 0.393156), (datetime.datetime(2020, 2, 28, 9, 42, 11, 333264), 0.393156), (datetime.datetime(2020, 2, 28, 9, 42, 11, 370415), 0.393156), (datetime.datetime(2020, 2, 28, 9, 42, 11, 459610), 0.393156), (datetime.datetime(2020, 2, 28, 9, 42, 11, 559668), 0.393156), (datetime.datetime(2020, 2, 28, 9, 42, 11, 659321), 0.393156), (datetime.datetime(2020, 2, 28, 9, 42, 11, 759402), 0.393156), (datetime.datetime(2020, 2, 28, 9, 42, 11, 859174), 0.393156), (datetime.datetime(2020, 2, 28, 9, 42, 11, 964476), 0.393156), (datetime.datetime(2020, 2, 28, 9, 42, 12, 59154), 0.393156), (datetime.datetime(2020, 2, 28, 9, 42, 12, 159137), 0.393156), (datetime.datetime(2020, 2, 28, 9, 42, 12, 258963), 0.393156), (datetime.datetime(2020, 2, 28, 9, 42, 12, 359124), 0.393156), (datetime.datetime(2020, 2, 28, 9, 42, 12, 458898), 0.393156), (datetime.datetime(2020, 2, 28, 9, 42, 12, 559332), 0.393156), (datetime.datetime(2020, 2, 28, 9, 42, 12, 658941), 0.393156), (datetime.datetime(2020, 2, 28, 9, 42, 12, 764933), 0.393156), (datetime.datetime(2020, 2, 28, 9, 42, 12, 858889), 0.393156), (datetime.datetime(2020, 2, 28, 9, 42, 12, 959432), 0.393156), (datetime.datetime(2020, 2, 28, 9, 42, 13, 59527), 0.393156), (datetime.datetime(2020, 2, 28, 9, 42, 13, 159407), 0.393156), (datetime.datetime(2020, 2, 28, 9, 42, 13, 259395), 0.393156)], maxlen=2000),
+        'speed_average_non_driven': TieredHistory(),
+        'throttle_position': TieredHistory(),
     }
+    for i in range(12000):
+        data['speed_average_non_driven'].append(i * 0.1, 55 + np.sin(i / 50))
+        data['throttle_position'].append(i * 0.1, 0.39 + i / 12000)
 
     ig = ImageGraph()
 
     gim = ig.drawgraph(data)
 
     gim.save('graph.png')
+
+    for i in range(12000, 12100):
+        data['speed_average_non_driven'].append(i * 0.1, 55 + np.sin(i / 50))
+        data['throttle_position'].append(i * 0.1, 0.39 + i / 12000)
+        ig.drawgraph(data)
+
+    ig.drawgraph(data).save('graph_updated.png')
@@ -1,23 +1,80 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 from collections import namedtuple
-from PIL import Image, ImageDraw, ImageFont
+import numpy as np
+from PIL import Image, ImageDraw
+
+from textcache import textcache, DIGITS
+from resources import truetype
 
 ImageMeatballStyle = namedtuple('ImageMeatballStyle', ['width', 'height', 'bgcolor', 'fgcolor',
                                                        'textcolor', 'accelquadcolor',
                                                        'decelquadcolor', 'latquadcolor', 'gridcolor',
                                                        'font'])
 
+# Static backgrounds, {(style, quadrant scales, image mode): image}
+_backgrounds = {}
+
 
 class ImageMeatball(object):
+    """Friction circle of lateral and longitudinal acceleration with a trail of recent history
+
+    The ball, grid and quadrant shading only change with the shading level, so they come
+    from a background cached per (style, quantized quadrant scales); a frame draws the trail,
+    the dot and the values over a copy of it.
+    """
     g_force = 9.81
+    SHADES = 20
 
     def __init__(self, gaugestyle: ImageMeatballStyle):
         self.style = gaugestyle
-        self.fontsmall = ImageFont.truetype(self.style.font, size=32)
-        self.fonttext = ImageFont.truetype(self.style.font, size=24)
 
-    def drawmeatball(self, ax, ay, history):
+    @property
+    def fontsmall(self):
+        return truetype(self.style.font, 32)
+
+    @property
+    def fonttext(self):
+        return truetype(self.style.font, 24)
+
+    def drawmeatball(self, ax, ay, history, im=None):
+        """Meatball image, drawn into im (e.g. a TileBuffer image of the style's size) when given"""
+        background = self._background(self.scalequads(ax, ay), im.mode if im is not None else 'RGB')
+        if im is None:
+            im = background.copy()
+        else:
+            im.paste(background)
+        draw = ImageDraw.Draw(im)
+
+        for box, shade in self._trail(history):
+            draw.ellipse(box, (shade, shade, 0))
+
+        dotx, doty = self.dotcoord(ax, ay)
+        draw.ellipse((dotx-15, doty-15, dotx+15, doty+15),
+                     self.style.bgcolor,
+                     self.style.textcolor,
+                     width=2)
+        draw.ellipse((dotx-10, doty-10, dotx+10, doty+10), self.style.textcolor)
+
+        self.drawvals(draw, ax, ay)
+
+        del draw
+
+        return im
+
+    def _background(self, scalequad, mode='RGB'):
+        """Ball, quadrant shading, grid rings and crosshair for quadrant scales, rendered on first use"""
+        # Quantized so shading levels, not every acceleration, get a cached background
+        scalequad = tuple(round(scale * ImageMeatball.SHADES) / ImageMeatball.SHADES for scale in scalequad)
+        key = (self.style, scalequad, mode)
+        background = _backgrounds.get(key)
+        if background is not None:
+            return background
+
+        if mode != 'RGB':
+            background = _backgrounds[key] = self._background(scalequad).convert(mode)
+            return background
+
         balldim = min(self.style.width, self.style.height)
 
         g_scaler = int((balldim / 2) / 1.25)
@@ -28,14 +85,16 @@ class ImageMeatball(object):
                     self.style.latquadcolor,
                     self.style.decelquadcolor]
 
+        # The value strings change with every reading, compose them from glyphs
+        textcache.prewarm(self.fontsmall, DIGITS + 'Lateral: Accelg', subpixels=1)
+
         im = Image.new('RGB', (self.style.width, self.style.height), self.style.bgcolor)
         draw = ImageDraw.Draw(im)
 
         draw.ellipse((0, 0, balldim, balldim), self.style.fgcolor)
-        sq = self.scalequads(ax, ay)
 
         for x in range(0, 4):
-            sc = self.scalecolor(slicecol[x], sq[x])
+            sc = self.scalecolor(slicecol[x], scalequad[x])
             draw.pieslice((3, 3, balldim-3, balldim-3), (x * 90) - 45, (x * 90) + 45, sc)
 
         draw.ellipse((quarter_g, quarter_g,
@@ -55,29 +114,31 @@ class ImageMeatball(object):
         draw.line((balldim/2, 0, balldim/2, balldim), fill=self.style.gridcolor)
         draw.line((0, balldim/2, balldim, balldim/2), fill=self.style.gridcolor)
 
-        hist = list(history)
+        del draw
 
-        for i, point in enumerate(hist):
-            dotx, doty = self.dotcoord(point[0], point[1])
-            dotscale = 15/len(history)
-            thisdot = int(i * dotscale)
-            colscale = 200/len(history)
-            thiscol = int(i * colscale)
+        _backgrounds[key] = im
 
-            draw.ellipse((dotx-thisdot, doty-thisdot, dotx+thisdot, doty+thisdot), (thiscol, thiscol, 0))
+        return im
 
-        dotx, doty = self.dotcoord(ax, ay)
-        draw.ellipse((dotx-15, doty-15, dotx+15, doty+15),
-                     self.style.bgcolor,
-                     self.style.textcolor,
-                     width=2)
-        draw.ellipse((dotx-10, doty-10, dotx+10, doty+10), self.style.textcolor)
+    def _trail(self, history):
+        """[(dot box, shade)] of the history points, oldest (smallest, darkest) first"""
+        points = np.asarray(history, dtype=float).reshape(-1, 2)
+        count = len(points)
+        if not count:
+            return []
 
-        self.drawvals(draw, ax, ay)
+        balldim = min(self.style.width, self.style.height)
+        g_scaler = int((balldim / 2) / 1.25)
 
-        del draw
+        # Same truncations as dotcoord(), for the whole trail at once
+        centre = balldim / 2 + np.trunc(points / ImageMeatball.g_force * g_scaler)
+        order = np.arange(count)
+        radius = (order * (15 / count)).astype(int)[:, None]
+        shade = (order * (200 / count)).astype(int)
 
-        return im
+        boxes = np.hstack((centre - radius, centre + radius))
+
+        return zip(boxes.tolist(), shade.tolist())
 
     def dotcoord(self, ax, ay):
         balldim = min(self.style.width, self.style.height)
@@ -98,17 +159,19 @@ class ImageMeatball(object):
         ytext = f'Accel: {gy:.02f}g'
 
         # fontbox1 = draw.textsize(xtext, font=self.fontsmall)
-        fontbox2 = draw.textsize(ytext, font=self.fontsmall)
-
-        draw.text((5, self.style.height - 50),
-                  xtext,
-                  fill=self.style.textcolor,
-                  font=self.fontsmall)
-
-        draw.text((self.style.width - 5 - fontbox2[0], self.style.height - 50),
-                  ytext,
-                  fill=self.style.textcolor,
-                  font=self.fontsmall)
+        fontbox2 = textcache.textsize(self.fontsmall, ytext)
+
+        textcache.text(draw,
+                       (5, self.style.height - 50),
+                       xtext,
+                       self.style.textcolor,
+                       self.fontsmall)
+
+        textcache.text(draw,
+                       (self.style.width - 5 - fontbox2[0], self.style.height - 50),
+                       ytext,
+                       self.style.textcolor,
+                       self.fontsmall)
 
         return draw
 
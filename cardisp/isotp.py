@@ -0,0 +1,67 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Minimal ISO-TP (ISO 15765-2) receive side for OBD responses on classic CAN
+
+Only what a Mode 22 poller needs: single frames, first frame + consecutive frame
+reassembly, and the flow control frame telling the ECU to send the rest.
+"""
+import logging
+
+import can
+
+SINGLE, FIRST, CONSECUTIVE, FLOWCONTROL = range(4)
+
+# Continue to send, no block size limit, no separation time
+FLOWCONTINUE = [0x30, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00]
+
+
+class IsoTpReceiver(object):
+    """Reassemble ISO-TP payloads per responder arbitration id
+
+    send - callable given the flow control can.Message to send after a first frame.
+    The flow control goes to the responder's physical request id, arbid - txoffset
+    (0x7E8 answers, 0x7E0 listens).
+    errors - count of out of sequence consecutive frames (their payload is discarded)
+    """
+
+    def __init__(self, send, txoffset=8):
+        self.send = send
+        self.txoffset = txoffset
+        self.errors = 0
+        self._partial = {}
+
+    def feed(self, message):
+        """Complete payload (service id first) from message, None while incomplete or for other frames"""
+        data = message.data
+        frametype = data[0] >> 4
+
+        if frametype == SINGLE:
+            return bytes(data[1:1 + (data[0] & 0x0F)])
+
+        if frametype == FIRST:
+            length = (data[0] & 0x0F) << 8 | data[1]
+            self._partial[message.arbitration_id] = [length, bytearray(data[2:]), 1]
+            self.send(can.Message(arbitration_id=message.arbitration_id - self.txoffset,
+                                  data=FLOWCONTINUE, is_extended_id=False))
+            return None
+
+        if frametype == CONSECUTIVE:
+            partial = self._partial.get(message.arbitration_id)
+            if partial is None:
+                return None
+
+            length, payload, sequence = partial
+            if data[0] & 0x0F != sequence:
+                self.errors += 1
+                del self._partial[message.arbitration_id]
+                logging.info(f'ISO-TP sequence error from {message.arbitration_id:#x}')
+                return None
+
+            payload += data[1:]
+            if len(payload) >= length:
+                del self._partial[message.arbitration_id]
+                return bytes(payload[:length])
+
+            partial[2] = (sequence + 1) & 0x0F
+
+        return None
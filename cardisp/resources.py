@@ -0,0 +1,61 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Process wide pool of fonts and shared gauge objects
+
+config.py describes about 60 gauges on a handful of styles, and every one used to load
+its own FreeType faces. Fonts come from here instead, loaded once per (path, size) on
+first use, and equal style/config tuples are interned so gauges built from them share
+one object (and its cached layers and text).
+"""
+from PIL import ImageFont
+
+_fonts = {}
+_interned = {}
+_shared = {}
+
+
+def truetype(path, size):
+    """PIL font for path and size, loaded on first use"""
+    key = ('pil', path, size)
+    font = _fonts.get(key)
+    if font is None:
+        font = _fonts[key] = ImageFont.truetype(path, size=size)
+
+    return font
+
+
+def pygamefont(path, size):
+    """pygame font for path and size, loaded on first use (pygame.font is initialized if needed)"""
+    import pygame
+
+    key = ('pygame', path, size)
+    font = _fonts.get(key)
+    if font is None:
+        if not pygame.font.get_init():
+            pygame.font.init()
+        font = _fonts[key] = pygame.font.Font(path, size)
+
+    return font
+
+
+def intern(value):
+    """The first value equal to value seen, so equal styles and configs are one object"""
+    return _interned.setdefault(value, value)
+
+
+def shared(cls, *args):
+    """One cls(*args) per distinct (interned) args, for objects that are the same when their args are"""
+    args = tuple(intern(arg) for arg in args)
+    instance = _shared.get((cls, args))
+    if instance is None:
+        instance = _shared[(cls, args)] = cls(*args)
+
+    return instance
+
+
+def stats():
+    return {
+        'fonts': len(_fonts),
+        'interned': len(_interned),
+        'shared': len(_shared),
+    }
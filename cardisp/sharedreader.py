@@ -0,0 +1,506 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""CAN ingest in a child process, published to the display process through shared memory
+
+The display process owns a multiprocessing.shared_memory block laid out from the signal
+registry (sorted DBC signal names). An IngestSupervisor thread spawns a child running
+SharedCanReader plus the OBD senders. The child writes current values, tracker state and
+the TieredHistory of the graphed signals straight into the block, and restarts if it dies.
+SharedReaderView gives the display process the CanReader interface hs_scan uses
+(snapshot, data, subscribe, boottiming, start, join) over read-only views of the block.
+
+Everything in the block is written and read under a multiprocessing.Lock, a process-shared
+semaphore, whose acquire and release also order the memory accesses on either side (plain
+numpy stores and loads don't, on the Pi's weakly ordered aarch64). The writer holds it per
+decoded frame and per publish, readers only while copying, so neither waits long. seq counts
+publishes, so readers can skip the copy when nothing was published.
+"""
+import time
+import queue
+import logging
+import multiprocessing
+from multiprocessing import shared_memory
+from threading import Thread, Event
+from contextlib import contextmanager
+
+import numpy as np
+
+import canwriter
+from canreader import CanReader, PerfTracker, AccelTracker, ReaderSnapshot, PerfSnapshot, AccelSnapshot
+from dbcache import loaddatabase
+from timeseries import TieredHistory, HISTORYTIERS, formatvalue
+
+PERFKEYS = tuple(PerfTracker().genPerfResult())
+ACCELHISTORY = AccelTracker().history.maxlen
+STATKEYS = ('frames', 'decoded', 'unsubscribed', 'rejected_python',
+            'wakeups', 'batchframes', 'batchtime', 'maxbatch')
+# OBDPidStats.summary() per canwriter.sendpids entry, NaN for None
+OBDNAMES = tuple(pid.name for pid in canwriter.sendpids)
+OBDSTATKEYS = ('sent', 'answered', 'negative', 'timeouts', 'answerrate', 'rate',
+               'latency_ms', 'latency_p95_ms', 'dropped')
+
+# Readers give up on the lock after this long (a killed writer can leave it held) and use what they had
+LOCKTIMEOUT = 0.05
+
+
+class SharedArena(object):
+    """Bump allocator handing out numpy arrays from one buffer, in call order
+
+    Without a buffer it only measures: arrays are plain np.zeros and offset ends up as the
+    size needed, so running the same construction twice sizes and then fills a block.
+    """
+
+    def __init__(self, buf=None):
+        self.buf = buf
+        self.offset = 0
+
+    def alloc(self, shape, dtype=np.float64):
+        dtype = np.dtype(dtype)
+        self.offset = (self.offset + 7) & ~7
+
+        if self.buf is None:
+            array = np.zeros(shape, dtype=dtype)
+        else:
+            array = np.ndarray(shape, dtype=dtype, buffer=self.buf, offset=self.offset)
+
+        self.offset += int(np.prod(shape)) * dtype.itemsize
+
+        return array
+
+
+class SharedTables(object):
+    """The arrays of the shared block, identical layout in both processes
+
+    seq - publishes so far
+    current - [signal, (timestamp, value)], timestamp 0 = no sample yet
+    perf - state, curr_et, distance, current_result[PERFKEYS], last_result[PERFKEYS]
+    accel - lat, accel, latmin, latmax, accelmin, accelmax, history length
+    accelhistory - [ACCELHISTORY, (lat, accel)]
+    stats - reader counters in STATKEYS order
+    obd - [OBDNAMES, OBDSTATKEYS] OBD scheduler stats, refreshed about once a second
+    histories - {signal: (TieredHistory, meta)} for the history signals
+    """
+
+    def __init__(self, arena, names, historysignals, tiers):
+        self.seq = arena.alloc(1, dtype=np.int64)
+        self.current = arena.alloc((len(names), 2))
+        self.perf = arena.alloc(3 + 2 * len(PERFKEYS))
+        self.accel = arena.alloc(7)
+        self.accelhistory = arena.alloc((ACCELHISTORY, 2))
+        self.stats = arena.alloc(len(STATKEYS))
+        self.obd = arena.alloc((len(OBDNAMES), len(OBDSTATKEYS)))
+
+        self.histories = {}
+        for sig in sorted(historysignals):
+            meta = arena.alloc((len(tiers), 2), dtype=np.int64)
+            self.histories[sig] = (TieredHistory(tiers, alloc=arena.alloc, meta=meta), meta)
+
+
+def _syncindex(history, meta):
+    """Load head/count of every tier from the shared meta rows"""
+    for series, (head, count) in zip([history.raw] + history.buckets, meta):
+        series.head = int(head)
+        series.count = int(count)
+
+
+class SharedCanReader(CanReader):
+    """CanReader publishing into SharedTables, run in the ingest child process
+
+    commands - queue of ('subscribe', consumer, names), ('unsubscribe', consumer),
+    ('decodeall', flag) and ('obdvisible', names) from the display process, applied between batches.
+    lock - the block's lock, held while a frame is decoded (histories) and while publishing
+    obdscheduler - the child's OBDScheduler, which gets the 'obdvisible' commands
+    """
+
+    def __init__(self, shmname, historysignals, commands, lock, tiers=HISTORYTIERS, obdscheduler=None, **kwargs):
+        self.shm = shared_memory.SharedMemory(name=shmname)
+        self.commands = commands
+        self.lock = lock
+        self.obdscheduler = obdscheduler
+        self._lastobdstats = 0
+
+        super(SharedCanReader, self).__init__(tiers=tiers, **kwargs)
+
+        self.names = sorted(self.cansignals)
+        self.index = {sig: i for i, sig in enumerate(self.names)}
+        self.tables = SharedTables(SharedArena(self.shm.buf), self.names, historysignals, tiers)
+
+        # Keep the history written by a previous (crashed) child
+        for sig, (history, meta) in self.tables.histories.items():
+            _syncindex(history, meta)
+            self.data[sig] = history
+
+        if obdscheduler is not None:
+            self.responsehandler = obdscheduler.onresponse
+
+    def publish(self):
+        super(SharedCanReader, self).publish()
+
+        # CanReader.__init__ publishes once before the tables exist
+        tables = getattr(self, 'tables', None)
+        if tables is None:
+            return
+
+        with self.lock:
+            for sig in self.subscribedsignals():
+                series = self.currentdata[sig]
+                if len(series):
+                    times, values = series.last(1)
+                    tables.current[self.index[sig]] = times[0], values[0]
+
+            pt = self.perftracker
+            tables.perf[:3] = pt.state, pt.curr_et, pt.distance
+            tables.perf[3:3 + len(PERFKEYS)] = [pt.current_result[k] for k in PERFKEYS]
+            tables.perf[3 + len(PERFKEYS):] = [pt.results[-1][k] for k in PERFKEYS]
+
+            at = self.acceltracer
+            history = list(at.history)
+            tables.accel[:] = (at.lat, at.accel, at.latminmax[0], at.latminmax[1],
+                               at.accelminmax[0], at.accelminmax[1], len(history))
+            if history:
+                tables.accelhistory[:len(history)] = history
+
+            tables.stats[:] = [self.stats[k] for k in STATKEYS]
+
+            if self.obdscheduler is not None and self._lastpublish - self._lastobdstats >= 1:
+                self._lastobdstats = self._lastpublish
+                obdstats = self.obdscheduler.getstats()
+                for row, name in zip(tables.obd, OBDNAMES):
+                    if name in obdstats:
+                        row[:] = [np.nan if obdstats[name][k] is None else obdstats[name][k] for k in OBDSTATKEYS]
+
+            tables.seq[0] += 1
+
+    def processframe(self, message):
+        # Histories are appended while decoding, so readers must not copy one halfway through
+        with self.lock:
+            super(SharedCanReader, self).processframe(message)
+
+    def pollcommands(self):
+        while True:
+            try:
+                command = self.commands.get_nowait()
+            except queue.Empty:
+                return
+
+            if command[0] == 'subscribe':
+                self.subscribe(command[1], command[2])
+            elif command[0] == 'unsubscribe':
+                self.unsubscribe(command[1])
+            elif command[0] == 'decodeall':
+                self.setdecodeall(command[1])
+            elif command[0] == 'obdvisible' and self.obdscheduler is not None:
+                self.obdscheduler.setvisible(command[1])
+
+    def run(self):
+        while self.running.is_set():
+            self.pollcommands()
+
+            batch = self.recvbatch()
+            if batch:
+                self.processbatch(batch)
+            elif self._dirty:
+                self.publish()
+
+
+def _ingestmain(shmname, stop, commands, lock, historysignals, readerargs, obd):
+    """Child process: reader thread plus OBD senders until stop is set"""
+    isrunning = Event()
+    isrunning.set()
+
+    scheduler = canwriter.OBDScheduler(readerargs['canbus'], readerargs.get('bustype', 'socketcan'),
+                                       isrunning=isrunning) if obd else None
+
+    reader = SharedCanReader(shmname, historysignals, commands, lock, isrunning=isrunning,
+                             obdscheduler=scheduler, **readerargs)
+    reader.start()
+
+    if scheduler is not None:
+        scheduler.start()
+
+    while not stop.wait(0.5):
+        if not reader.is_alive():
+            logging.error('CAN reader thread died, exiting ingest process.')
+            break
+
+    isrunning.clear()
+
+    reader.join()
+    if scheduler is not None:
+        scheduler.join()
+
+    reader.shm.close()
+
+
+class IngestSupervisor(Thread):
+    """Run the ingest child process, restarting it whenever it exits while isrunning is set"""
+
+    def __init__(self, view, isrunning, restartdelay=1.0):
+        super(IngestSupervisor, self).__init__(name='IngestSupervisor')
+        self.view = view
+        self.isrunning = isrunning
+        self.restartdelay = restartdelay
+        self.restarts = 0
+        self.process = None
+        # spawn, not fork: the display process has SDL and several threads running by the time a
+        # child (re)starts, and a forked child would inherit their state and any locks they held
+        self.context = multiprocessing.get_context('spawn')
+        self.stop = None
+
+    def _startchild(self):
+        # Fresh event, queue and block lock per child - a killed child can leave their locks unusable
+        self.stop = self.context.Event()
+        commands = self.context.Queue()
+        self.view.commands = commands
+        lock = self.context.Lock()
+        self.view.lock = lock
+
+        # Replay after swapping the queue in, so a subscribe racing with us is at worst sent twice
+        for consumer, names in list(self.view.subscriptions.items()):
+            commands.put(('subscribe', consumer, names))
+        commands.put(('decodeall', self.view.decodeall))
+        if self.view.obdvisible is not None:
+            commands.put(('obdvisible', self.view.obdvisible))
+        self.process = self.context.Process(target=_ingestmain, name='CanIngest',
+                                            args=(self.view.shm.name, self.stop, commands, lock,
+                                                  self.view.historysignals, self.view.readerargs,
+                                                  self.view.obd))
+        self.process.start()
+        logging.warning(f'Started CAN ingest process {self.process.pid}')
+
+    def run(self):
+        self._startchild()
+
+        while self.isrunning.is_set():
+            if not self.process.is_alive():
+                logging.warning(f'CAN ingest process exited with {self.process.exitcode}, restarting.')
+                # No writer until the restart, and the dead one may have left its lock held
+                self.view.lock = None
+                self.restarts += 1
+                time.sleep(self.restartdelay)
+                self._startchild()
+
+            time.sleep(0.5)
+
+        self.stop.set()
+        self.process.join(timeout=5)
+        if self.process.is_alive():
+            self.process.terminate()
+
+        self.view.close()
+
+
+class SharedHistory(object):
+    """Read-only TieredHistory over the shared block, synced to the writer on every read
+
+    Reads are made under the block lock and return copies, so the writer can't move the
+    ring under them. If the lock can't be had they return the last result.
+    """
+
+    def __init__(self, history, meta, view):
+        self.history = history
+        self.meta = meta
+        self.view = view
+        self._len = 0
+        self._lasttime = None
+        self._window = None
+
+    def __len__(self):
+        with self.view.locked() as locked:
+            if locked:
+                _syncindex(self.history, self.meta)
+                self._len = len(self.history)
+
+        return self._len
+
+    @property
+    def lasttime(self):
+        with self.view.locked() as locked:
+            if locked:
+                _syncindex(self.history, self.meta)
+                self._lasttime = self.history.lasttime
+
+        return self._lasttime
+
+    def window(self, seconds=None, maxpoints=1000):
+        with self.view.locked() as locked:
+            if locked:
+                _syncindex(self.history, self.meta)
+                self._window = tuple(np.array(points) for points in self.history.window(seconds, maxpoints))
+
+        if self._window is None:
+            empty = np.zeros(0)
+            return empty, empty, empty, empty
+
+        return self._window
+
+
+class SharedReaderView(object):
+    """Display process side of the ingest process, with the CanReader interface used by hs_scan
+
+    historysignals - signals whose TieredHistory is shared (the graphed ones), available in data
+    obd - run the OBD senders in the ingest process too
+    Other keyword arguments go to SharedCanReader/CanReader in the child.
+    """
+
+    def __init__(self, isrunning, dbc=[], historysignals=(), tiers=HISTORYTIERS, obd=True,
+                 decodeall=False, **readerargs):
+        self.db, self.cansignals, self.boottiming = loaddatabase(dbc, usecache=readerargs.get('dbcache', True))
+
+        self.names = sorted(self.cansignals)
+        self.index = {sig: i for i, sig in enumerate(self.names)}
+        dbsignals = {signal.name: signal for message in self.db.messages for signal in message.signals}
+        self.formats = {sig: CanReader._valueformat(dbsignals[sig]) for sig in self.names}
+
+        self.historysignals = sorted(set(historysignals) & set(self.names))
+        self.readerargs = dict(readerargs, dbc=dbc)
+        self.readerargs.setdefault('canbus', 'vcan0')
+        self.obd = obd
+        self.decodeall = decodeall
+        self.subscriptions = {'trackers': CanReader.TRACKERSIGNALS}
+        self.obdvisible = None
+        self.commands = None
+        # Set by the supervisor for each child, None while no child has been started
+        self.lock = None
+
+        measure = SharedArena()
+        SharedTables(measure, self.names, self.historysignals, tiers)
+        self.shm = shared_memory.SharedMemory(create=True, size=max(measure.offset, 1))
+        self.tables = SharedTables(SharedArena(self.shm.buf), self.names, self.historysignals, tiers)
+        self.tables.seq[0] = 0
+        self.tables.current[:] = 0
+
+        self.data = {sig: SharedHistory(history, meta, self) for sig, (history, meta) in self.tables.histories.items()}
+        logging.warning(f'Shared ingest block {self.shm.name}: {measure.offset / 1024:.0f}KiB, '
+                        f'{len(self.names)} signals, {len(self.historysignals)} with history')
+
+        self._snapshot = None
+        self._snapshotseq = -1
+        self.supervisor = IngestSupervisor(self, isrunning)
+
+    def start(self):
+        self.supervisor.start()
+
+    def join(self):
+        self.supervisor.join()
+
+    def close(self):
+        self.shm.close()
+        self.shm.unlink()
+
+    def _send(self, command):
+        if self.commands is not None:
+            self.commands.put(command)
+
+    def subscribe(self, consumer, signalnames):
+        self.subscriptions[consumer] = frozenset(signalnames)
+        self._send(('subscribe', consumer, self.subscriptions[consumer]))
+        self._snapshotseq = -1
+
+    def unsubscribe(self, consumer):
+        self.subscriptions.pop(consumer, None)
+        self._send(('unsubscribe', consumer))
+        self._snapshotseq = -1
+
+    def setdecodeall(self, decodeall):
+        self.decodeall = decodeall
+        self._send(('decodeall', decodeall))
+
+    def setvisible(self, signalnames):
+        """OBDScheduler.setvisible() on the child's scheduler"""
+        self.obdvisible = frozenset(signalnames)
+        self._send(('obdvisible', self.obdvisible))
+
+    def subscribedsignals(self):
+        if self.decodeall:
+            return frozenset(self.names)
+
+        return frozenset().union(*self.subscriptions.values())
+
+    @contextmanager
+    def locked(self):
+        """Hold the block lock for the with block, giving whether it was had within LOCKTIMEOUT"""
+        lock = self.lock
+        if lock is None:
+            # No child started yet, so no writer
+            yield True
+            return
+
+        if not lock.acquire(timeout=LOCKTIMEOUT):
+            yield False
+            return
+
+        try:
+            yield True
+        finally:
+            lock.release()
+
+    def _copytables(self):
+        """Consistent copy of the published arrays, None if the lock couldn't be had"""
+        tables = self.tables
+        with self.locked() as locked:
+            if not locked:
+                return None
+
+            return int(tables.seq[0]), (tables.current.copy(), tables.perf.copy(), tables.accel.copy(),
+                                        tables.accelhistory.copy(), tables.stats.copy(), tables.obd.copy())
+
+    @property
+    def snapshot(self):
+        """ReaderSnapshot rebuilt from the shared block when the writer has published since the last call"""
+        # An unlocked peek: a stale count only delays the rebuild to the next call
+        seq = int(self.tables.seq[0])
+        if seq == self._snapshotseq and self._snapshot is not None:
+            return self._snapshot
+
+        copied = self._copytables()
+        if copied is None:
+            if self._snapshot is not None:
+                return self._snapshot
+
+            # Nothing read yet: the snapshot of a block no child has written, rebuilt on the next call
+            tables = self.tables
+            arrays = (tables.current, tables.perf, tables.accel, tables.accelhistory, tables.stats, tables.obd)
+            copied = -1, tuple(np.zeros_like(array) for array in arrays)
+
+        seq, (current, perf, accel, accelhistory, _, _) = copied
+
+        values = {}
+        for sig in self.subscribedsignals():
+            timestamp, value = current[self.index[sig]]
+            if timestamp:
+                values[sig] = formatvalue(value.item(), *self.formats[sig])
+
+        n = len(PERFKEYS)
+        perfsnapshot = PerfSnapshot(int(perf[0]), perf[1].item(), perf[2].item(),
+                                    dict(zip(PERFKEYS, perf[3:3 + n].tolist())),
+                                    dict(zip(PERFKEYS, perf[3 + n:].tolist())))
+        accelsnapshot = AccelSnapshot(accel[0].item(), accel[1].item(),
+                                      tuple(accel[2:4].tolist()), tuple(accel[4:6].tolist()),
+                                      tuple(map(tuple, accelhistory[:int(accel[6])].tolist())))
+
+        self._snapshot = ReaderSnapshot(seq, time.time(), values, perfsnapshot, accelsnapshot)
+        self._snapshotseq = seq
+
+        return self._snapshot
+
+    def getstats(self):
+        copied = self._copytables()
+        stats = dict(zip(STATKEYS, copied[1][4].tolist())) if copied else {}
+        stats['restarts'] = self.supervisor.restarts
+
+        return stats
+
+    def getobdstats(self):
+        """OBDScheduler.getstats() of the child's scheduler, as of its last refresh"""
+        copied = self._copytables()
+        if copied is None:
+            return {}
+
+        obdstats = {}
+        for name, row in zip(OBDNAMES, copied[1][5]):
+            stats = {k: (None if np.isnan(v) else v) for k, v in zip(OBDSTATKEYS, row.tolist())}
+            stats['dropped'] = bool(stats['dropped'])
+            obdstats[name] = stats
+
+        return obdstats
@@ -0,0 +1,298 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Scrolling strip chart of TieredHistory signals drawn with pygame
+
+A lighter ImageGraph: no matplotlib, and a frame only scrolls the plot left by the time
+elapsed and draws the newest strip of columns. Times and values are mapped to pixels with
+numpy and the traces drawn with pygame.draw.lines()/polygon() on the whole point arrays.
+"""
+import math
+import logging
+
+import numpy as np
+import pygame
+
+from timeseries import TieredHistory
+from resources import pygamefont
+
+# matplotlib's dark_background colour cycle, so both graph backends look alike
+COLORS = [(0x8d, 0xd3, 0xc7), (0xfe, 0xff, 0xb3), (0xbf, 0xbb, 0xd9), (0xfa, 0x81, 0x74),
+          (0x81, 0xb1, 0xd2), (0xfd, 0xb4, 0x62), (0xb3, 0xde, 0x69), (0xbc, 0x82, 0xbd)]
+
+
+def fitlimits(low, high, shown, headroom=0.25, shrink=0.5):
+    """Axis limits for data spanning low..high
+
+    shown is kept while the data stays inside it and uses at least shrink of it, so a
+    climbing trace doesn't rescale the axis every frame. New limits get headroom (a
+    fraction of the data range) split above and below. shown None always fits new limits.
+    """
+    if low > high:
+        return shown if shown is not None else (0, 1)
+
+    if high - low < 1e-9:
+        low, high = low - 0.5, high + 0.5
+
+    if shown is not None and shown[0] <= low and high <= shown[1] \
+            and (high - low) >= shrink * (shown[1] - shown[0]):
+        return shown
+
+    pad = (high - low) * headroom / 2
+    return (low - pad, high + pad)
+
+
+def ticks(low, high, count=6):
+    """Round tick values from low to high, about count of them"""
+    step = (high - low) / count
+    magnitude = 10 ** math.floor(math.log10(step))
+    for nice in (1, 2, 2.5, 5, 10):
+        if step <= nice * magnitude:
+            step = nice * magnitude
+            break
+
+    return np.arange(math.ceil(low / step) * step, high + step * 1e-6, step)
+
+
+class StripChart(object):
+    """Trend graph of TieredHistory signals on a persistent pygame surface, same use as ImageGraph
+
+    size - (width, height) of the graph surface
+    font - TTF for the tick labels and legend
+    window - seconds of history shown, None for the whole drive
+    maxpoints - upper bound of points per trace, see TieredHistory.window()
+
+    Traces go on their own layer (black is transparent) over a background of axes, grid and
+    legend. The background is drawn again only when the signals, window or axis limits
+    change; otherwise the trace layer scrolls by the whole pixels elapsed and only the strip
+    on the right is cleared and drawn. The strip reaches back PAD columns past the earliest
+    trace's last drawn sample, so a sparse trace gets the whole segment to its new samples.
+    """
+    ZOOMS = [10, 30, 120, 600, 1800, None]
+    PAD = 4
+
+    def __init__(self, size=(1280, 720), font='fonts/segoeui.ttf', window=120, maxpoints=1000,
+                 bgcolor=(0, 0, 0), textcolor=(255, 255, 255), gridcolor=(0x33, 0x33, 0x33)):
+        self.size = size
+        self.fontpath = font
+        self.window = window
+        self.maxpoints = maxpoints
+        self.bgcolor = bgcolor
+        self.textcolor = textcolor
+        self.gridcolor = gridcolor
+
+        self.plot = pygame.Rect(100, 60, size[0] - 130, size[1] - 140)
+        # Font and surfaces are made when the graph is first drawn
+        self.font = None
+        self.surface = self.background = self.traces = None
+
+        self.names = None
+        self.limits = None
+        self.xscale = self.yscale = 1
+        self.drawnnow = None
+        # Time of the last sample drawn of each trace, None for traces without data
+        self.drawntimes = []
+
+    def drawsurface(self, kpis: dict):
+        """The graph surface, updated with kpis {label: TieredHistory}. Drawn over by the next call."""
+        names = tuple(kpis)
+        traces = []
+        low, high = np.inf, -np.inf
+        now = start = None
+        for kpi in kpis.values():
+            try:
+                times, mins, maxs, means = kpi.window(self.window, self.maxpoints)
+            except Exception:
+                logging.info('Data formatting failed')
+                times = mins = maxs = means = np.zeros(0)
+
+            traces.append((times, mins, maxs, means))
+            if len(times):
+                low, high = min(low, np.nanmin(mins)), max(high, np.nanmax(maxs))
+                now = times[-1] if now is None else max(now, times[-1])
+                start = times[0] if start is None else min(start, times[0])
+
+        shown = self.limits if names == self.names else (None, None)
+        limits = (self._xlimit(shown[0], now - start if now is not None else 0),
+                  fitlimits(low, high, shown[1]))
+
+        if now is None:
+            now = self.drawnnow or 0
+
+        if names != self.names or limits != self.limits or self.drawnnow is None or now < self.drawnnow \
+                or (now - self.drawnnow) * self.xscale >= self.plot.width:
+            self._drawfull(names, limits, traces, now)
+        else:
+            self._scroll(traces, now)
+
+        self.surface.blit(self.background, self.plot.topleft, self.plot)
+        self.surface.blit(self.traces, self.plot.topleft)
+
+        return self.surface
+
+    def _xlimit(self, shown, span):
+        """Seconds shown: the window, or for the whole drive a span growing in steps"""
+        if self.window is not None:
+            return self.window
+
+        if shown is None or span > shown:
+            shown = max(span, 1) * 1.25
+
+        return shown
+
+    def _scroll(self, traces, now):
+        shift = int((now - self.drawnnow) * self.xscale)
+        if shift:
+            self.traces.scroll(-shift, 0)
+            self.drawnnow += shift / self.xscale
+
+        left = self.plot.width - shift
+        for drawn in self.drawntimes:
+            if drawn is not None:
+                left = min(left, int(self._x(drawn)))
+        left = max(left - self.PAD, 0)
+
+        strip = pygame.Rect(left, 0, self.plot.width - left, self.plot.height)
+        self.traces.set_clip(strip)
+        self.traces.fill((0, 0, 0))
+        self._drawtraces(traces, self.drawnnow - strip.width / self.xscale)
+        self.traces.set_clip(None)
+
+    def _drawtraces(self, traces, start=None):
+        """Draw traces (from the sample before time start) on the trace layer, bands under lines"""
+        lines = []
+        self.drawntimes = [times[-1] if len(times) else None for times, _, _, _ in traces]
+        for (times, mins, maxs, means), color in zip(traces, COLORS):
+            band = mins is not maxs
+            if start is not None:
+                first = max(np.searchsorted(times, start) - 1, 0)
+                times, mins, maxs, means = times[first:], mins[first:], maxs[first:], means[first:]
+
+            if len(times) < 2:
+                continue
+
+            x = self._x(times)
+            if band:
+                bandx = np.concatenate((x, x[::-1]))
+                bandy = np.concatenate((self._y(maxs), self._y(mins[::-1])))
+                pygame.draw.polygon(self.traces, tuple(int(c * 0.3) for c in color),
+                                    np.column_stack((bandx, bandy)).tolist())
+
+            lines.append((color, np.column_stack((x, self._y(means))).tolist()))
+
+        for color, points in lines:
+            pygame.draw.lines(self.traces, color, False, points, 2)
+
+    def _x(self, times):
+        return (times - self.drawnnow) * self.xscale + (self.plot.width - 1)
+
+    def _y(self, values):
+        return (self.limits[1][1] - values) * self.yscale
+
+    def _drawfull(self, names, limits, traces, now):
+        if self.font is None:
+            self.font = pygamefont(self.fontpath, 24)
+            self.surface = pygame.Surface(self.size)
+            self.background = pygame.Surface(self.size)
+            self.traces = pygame.Surface(self.plot.size)
+            self.traces.set_colorkey((0, 0, 0))
+
+        self.names = names
+        self.limits = limits
+        self.drawnnow = now
+        span, (low, high) = limits
+        self.xscale = (self.plot.width - 1) / span
+        self.yscale = (self.plot.height - 1) / (high - low)
+
+        self._drawbackground()
+
+        self.traces.fill((0, 0, 0))
+        self._drawtraces(traces)
+
+        self.surface.blit(self.background, (0, 0))
+
+    def _drawbackground(self):
+        bg = self.background
+        plot = self.plot
+        span, (low, high) = self.limits
+        bg.fill(self.bgcolor)
+
+        for tick in ticks(-span, 0):
+            x = plot.right - 1 + int(tick * self.xscale)
+            pygame.draw.line(bg, self.gridcolor, (x, plot.top), (x, plot.bottom - 1))
+            self._text(f'{tick:g}', (x, plot.bottom + 4), 'midtop')
+
+        for tick in ticks(low, high):
+            y = plot.top + int((high - tick) * self.yscale)
+            pygame.draw.line(bg, self.gridcolor, (plot.left, y), (plot.right - 1, y))
+            self._text(f'{tick:g}', (plot.left - 8, y), 'midright')
+
+        pygame.draw.rect(bg, self.textcolor, plot.inflate(2, 2), 1)
+        self._text('Rel Time(s)', (plot.centerx, self.size[1] - 8), 'midbottom')
+
+        # Legend across the top, wrapping like the matplotlib one
+        x, y = 10, 8
+        for name, color in zip(self.names, COLORS):
+            width = 50 + self.font.size(name)[0]
+            if x > 10 and x + width > self.size[0] - 10:
+                x, y = 10, y + 30
+            pygame.draw.line(bg, color, (x, y + 14), (x + 40, y + 14), 2)
+            self._text(name, (x + 50, y + 14), 'midleft')
+            x += width + 40
+
+    def _text(self, text, pos, anchor):
+        image = self.font.render(text, True, self.textcolor)
+        self.background.blit(image, image.get_rect(**{anchor: pos}))
+
+
+if __name__ == '__main__':
+    import time
+
+    data = {
+        'speed_average_non_driven': TieredHistory(),
+        'throttle_position': TieredHistory(),
+    }
+    for i in range(12000):
+        data['speed_average_non_driven'].append(i * 0.1, 55 + np.sin(i / 50))
+        data['throttle_position'].append(i * 0.1, 0.39 + i / 12000)
+
+    chart = StripChart()
+    chart.drawsurface(data)
+
+    started = time.perf_counter()
+    for i in range(12000, 12100):
+        data['speed_average_non_driven'].append(i * 0.1, 55 + np.sin(i / 50))
+        data['throttle_position'].append(i * 0.1, 0.39 + i / 12000)
+        chart.drawsurface(data)
+    print(f'{(time.perf_counter() - started) * 10:.2f}ms per frame')
+
+    pygame.image.save(chart.surface, 'stripchart.png')
+
+    # A fast (50/s) and a sparse (1/s) trace: after scrolling, the trace layer should match a full
+    # redraw, give or take the odd pixel of a line rasterized from a clipped start
+    sparse = {'fast': TieredHistory(), 'sparse': TieredHistory()}
+    chart = StripChart(window=10)
+    for i in range(2000):
+        if i % 2 == 0:
+            sparse['fast'].append(i * 0.01, np.sin(i * 0.05))
+        if i % 100 == 0:
+            sparse['sparse'].append(i * 0.01, np.cos(i * 0.01))
+        if i >= 1000 and i % 5 == 0:
+            chart.drawsurface(sparse)
+
+    full = StripChart(window=10)
+    full._drawfull(chart.names, chart.limits, [kpi.window(10, full.maxpoints) for kpi in sparse.values()],
+                   chart.drawnnow)
+
+    def near(drawn, distance=2):
+        grown = drawn.copy()
+        for dx in range(-distance, distance + 1):
+            for dy in range(-distance, distance + 1):
+                grown |= np.roll(drawn, (dx, dy), (0, 1))
+        return grown
+
+    # Columns near the left edge show where the window starts, which differs between the two
+    scrolled = pygame.surfarray.array2d(chart.traces)[10:] != 0
+    redrawn = pygame.surfarray.array2d(full.traces)[10:] != 0
+    stray = (scrolled & ~near(redrawn)) | (redrawn & ~near(scrolled))
+    print(f'sparse trace: {np.count_nonzero(stray)} of {np.count_nonzero(redrawn)} trace pixels '
+          f'more than 2px from a full redraw')
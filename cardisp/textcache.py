@@ -0,0 +1,225 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Rendered text shared by every screen
+
+Most text on the display repeats from frame to frame (labels, values that haven't
+changed, the perf screen between runs), yet each frame rasterized it again with FreeType.
+TextCache keeps the rendered text - pygame surfaces for hs_scan, coverage masks for the
+PIL gauges - in one bounded LRU, and can compose numbers from pre-rendered digit glyphs
+so a new value doesn't need FreeType either.
+"""
+import math
+from collections import OrderedDict
+
+from PIL import Image, ImageDraw
+
+DIGITS = '0123456789.-'
+
+# Masks are rendered this far in from their corner before cropping, so glyphs reaching left
+# of or above the pen position aren't clipped
+MARGIN = 4
+
+
+class TextCache(object):
+    """Bounded LRU of rendered text, keyed by (font, text, colour or subpixel start)
+
+    maxsize - entries kept, least recently used dropped first
+    sizesize - text sizes kept, in an LRU of their own so measuring changing values
+               doesn't push rendered text out
+    hits, misses - text lookups served from the cache, and rendered (then cached)
+    sizehits, sizemisses - the same for textsize()
+    composed - PIL strings drawn from pre-rendered glyphs (see prewarm())
+    """
+
+    def __init__(self, maxsize=256, sizesize=64):
+        self.maxsize = maxsize
+        self.sizesize = sizesize
+        self.hits = 0
+        self.misses = 0
+        self.sizehits = 0
+        self.sizemisses = 0
+        self.composed = 0
+        self._entries = OrderedDict()
+        self._sizes = OrderedDict()
+        # {font: {char: ({subpixel start: (mask, offset)}, {following char: advance})}}
+        self._glyphs = {}
+        # {font: subpixels}, the grid composed glyphs are placed on
+        self._subpixels = {}
+        self._measure = ImageDraw.Draw(Image.new('L', (1, 1)))
+
+    @staticmethod
+    def _lookup(entries, maxsize, key, create):
+        """(entry, hit) for key, created and added (dropping the least recently used) on a miss"""
+        entry = entries.get(key)
+        if entry is not None:
+            entries.move_to_end(key)
+            return entry, True
+
+        entry = entries[key] = create()
+        if len(entries) > maxsize:
+            entries.popitem(last=False)
+
+        return entry, False
+
+    def _get(self, key, create):
+        entry, hit = self._lookup(self._entries, self.maxsize, key, create)
+        if hit:
+            self.hits += 1
+        else:
+            self.misses += 1
+
+        return entry
+
+    def render(self, font, text, color, antialias=True):
+        """pygame surface of text, as font.render(text, antialias, color)"""
+        return self._get(('render', font, text, color, antialias),
+                         lambda: font.render(text, antialias, color))
+
+    def textsize(self, font, text):
+        """(width, height) of text, as ImageDraw.textsize()"""
+        size, hit = self._lookup(self._sizes, self.sizesize, (font, text),
+                                 lambda: self._measure.textsize(text, font=font))
+        if hit:
+            self.sizehits += 1
+        else:
+            self.sizemisses += 1
+
+        return size
+
+    def text(self, draw, xy, text, fill, font):
+        """ImageDraw.text(xy, text, fill, font) on draw's image, through cached masks
+
+        Strings made only of characters prewarmed for font (see prewarm()) and not cached
+        whole are placed glyph by glyph instead of being rendered, to the nearest subpixel
+        step prewarm() was given.
+        """
+        glyphs = self._glyphs.get(font)
+        start = (math.modf(xy[0])[0], math.modf(xy[1])[0])
+        key = ('mask', font, text) + start
+        if glyphs is not None and key not in self._entries and all(char in glyphs for char in text):
+            self.composed += 1
+            subpixels = self._subpixels[font]
+            y, ystart = self._snap(xy[1], subpixels)
+            x = xy[0]
+            for char, following in zip(text, text[1:] + ' '):
+                pixel, xstart = self._snap(x, subpixels)
+                mask, offset = self._glyph(font, glyphs[char], char, (xstart, ystart))
+                if mask is not None:
+                    draw.bitmap((pixel + offset[0], y + offset[1]), mask, fill=fill)
+                x += self._advance(font, glyphs[char], char, following)
+            return
+
+        mask, offset = self._get(key, lambda: self._rendermask(font, text, start))
+        if mask is not None:
+            draw.bitmap((int(xy[0]) + offset[0], int(xy[1]) + offset[1]), mask, fill=fill)
+
+    def _rendermask(self, font, text, start):
+        """(mask, offset) of text drawn at start, the fractional part of its position
+
+        mask - 'L' coverage of the inked pixels only (blending costs per mask pixel), None if none
+        offset - where the mask goes from the whole pixel position, to land on the pixels
+                 ImageDraw.text() would draw
+        """
+        left, top, right, bottom = font.getbbox(text)
+        mask = Image.new('L', (right + 2 * MARGIN + 1, bottom + 2 * MARGIN + 1))
+        ImageDraw.Draw(mask).text((start[0] + MARGIN, start[1] + MARGIN), text, fill=255, font=font)
+
+        box = mask.getbbox()
+        if box is None:
+            return None, (0, 0)
+
+        return mask.crop(box), (box[0] - MARGIN, box[1] - MARGIN)
+
+    def prewarm(self, font, chars=DIGITS, subpixels=2):
+        """Render glyphs of chars for font now, and from then on compose strings of only those chars
+
+        subpixels - steps per pixel glyphs are rendered and placed at, on both axes, so each
+                    glyph has at most subpixels ** 2 masks. Text drawn on that grid (e.g. centred
+                    on whole pixels with subpixels=2) matches ImageDraw.text() for hinted fonts,
+                    where every glyph lands at the string's own subpixel start. Elsewhere it is
+                    moved by up to half a step.
+        """
+        self._subpixels[font] = max(subpixels, self._subpixels.get(font, 1))
+        starts = [step / self._subpixels[font] for step in range(self._subpixels[font])]
+
+        glyphs = self._glyphs.setdefault(font, {})
+        for char in chars:
+            glyph = glyphs.setdefault(char, ({}, {}))
+            for xstart in starts:
+                for ystart in starts:
+                    self._glyph(font, glyph, char, (xstart, ystart))
+
+    @staticmethod
+    def _snap(position, subpixels):
+        """(whole pixel, subpixel start) of position rounded to the nearest 1/subpixels"""
+        position = round(position * subpixels) / subpixels
+        pixel = math.floor(position)
+
+        return pixel, position - pixel
+
+    def _advance(self, font, glyph, char, following):
+        """Pen advance after char when following comes next, including any kerning between them"""
+        advances = glyph[1]
+        advance = advances.get(following)
+        if advance is None:
+            advance = advances[following] = font.getlength(char + following) - font.getlength(following)
+
+        return advance
+
+    def _glyph(self, font, glyph, char, start):
+        """(mask, offset) of char at a subpixel start (on the prewarm() grid), rendered on first use"""
+        masks = glyph[0]
+        mask = masks.get(start)
+        if mask is None:
+            mask = masks[start] = self._rendermask(font, char, start)
+
+        return mask
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        sizelookups = self.sizehits + self.sizemisses
+        return {
+            'entries': len(self._entries),
+            'hits': self.hits,
+            'misses': self.misses,
+            'composed': self.composed,
+            'hitrate': self.hits / lookups if lookups else 0,
+            'sizes': len(self._sizes),
+            'sizehitrate': self.sizehits / sizelookups if sizelookups else 0,
+        }
+
+
+# The one cache every screen draws text through
+textcache = TextCache()
+
+
+if __name__ == '__main__':
+    import timeit
+    from PIL import ImageChops, ImageFont
+
+    font = ImageFont.truetype('fonts/segoeui.ttf', size=110)
+    values = [f'{v:.1f}' for v in range(-50, 250, 3)]
+
+    def direct():
+        im = Image.new('RGB', (320, 360))
+        draw = ImageDraw.Draw(im)
+        for value in values:
+            draw.text((160 - draw.textsize(value, font=font)[0] / 2, 125), value, fill=(255, 255, 255), font=font)
+        return im
+
+    def cached(cache):
+        im = Image.new('RGB', (320, 360))
+        draw = ImageDraw.Draw(im)
+        for value in values:
+            cache.text(draw, (160 - cache.textsize(font, value)[0] / 2, 125), value, (255, 255, 255), font)
+        return im
+
+    cache = TextCache()
+    print('identical', ImageChops.difference(direct(), cached(cache)).getbbox() is None)
+    print(f'direct {timeit.timeit(direct, number=5) / 5 / len(values) * 1e6:.0f}us per value')
+    print(f'cached {timeit.timeit(lambda: cached(cache), number=5) / 5 / len(values) * 1e6:.0f}us per value')
+
+    composing = TextCache()
+    composing.prewarm(font)
+    print(f'composed {timeit.timeit(lambda: cached(composing), number=5) / 5 / len(values) * 1e6:.0f}us per value')
+    print(cache.stats(), composing.stats())
@@ -0,0 +1,42 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""PIL images that draw straight into pygame surfaces
+
+The renderers draw with PIL, and pygame blits the result. Going through
+image.tobytes() and pygame.image.fromstring() copies every frame twice and allocates
+two frame sized buffers. A TileBuffer keeps one buffer per tile for the life of the
+display that both libraries use, so a redraw allocates nothing and the only copy is
+the blit onto the screen.
+"""
+import pygame
+from PIL import Image
+
+
+class TileBuffer(object):
+    """A PIL image and a pygame surface over the same pixels
+
+    size - (width, height) in pixels
+    image - PIL 'RGBX' image to draw into (e.g. ImageGauge.drawinto())
+    surface - pygame surface showing what was drawn into image, ready to blit
+
+    RGBX rather than RGBA, so blits copy pixels instead of alpha blending them.
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self.buffer = bytearray(size[0] * size[1] * 4)
+
+        self.image = Image.frombuffer('RGBX', size, self.buffer, 'raw', 'RGBX', 0, 1)
+        # Images over a buffer are read only and copy themselves on the first draw. Draw in place.
+        self.image.readonly = 0
+
+        self.surface = pygame.image.frombuffer(self.buffer, size, 'RGBX')
+
+
+if __name__ == '__main__':
+    from PIL import ImageDraw
+
+    tile = TileBuffer((320, 360))
+    ImageDraw.Draw(tile.image).ellipse((10, 10, 310, 350), fill=(0, 255, 0))
+
+    print(tile.surface.get_at((160, 180)), tile.surface.get_at((0, 0)))
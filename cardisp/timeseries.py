@@ -0,0 +1,270 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+from collections import namedtuple
+
+import numpy as np
+
+
+def formatvalue(value, labels=None, integer=False):
+    """Stored float back to the signal's value: int for integer signals, choice name if labelled"""
+    if integer:
+        value = int(value)
+    if labels is not None:
+        return labels.get(value, value)
+
+    return value
+
+
+class TimeSeries(object):
+    """Preallocated ring buffer of (timestamp, value) samples for one signal
+
+    Timestamps are float64 epoch seconds (CAN frame receive time - convert with
+    datetime.datetime.fromtimestamp() only for display or export), values are stored
+    as dtype (float32 for history, float64 by default). Every sample is written twice,
+    at slot i and i + capacity, so the most recent n samples are always one contiguous
+    slice of the backing arrays - last() and lastseconds() return views, not copies.
+
+    Indexing keeps the old deque-of-tuples interface: series[-1] is (timestamp, value).
+    labels - optional {value: label} for enumerated signals, applied when indexing.
+    integer - return values as int when indexing (for signals with integer scaling).
+    alloc - array allocator (shape, dtype), np.zeros unless the arrays live in shared memory.
+    meta - optional int64[2] array mirroring (head, count) for readers in another process.
+    """
+
+    def __init__(self, capacity, dtype=np.float64, labels=None, integer=False, alloc=np.zeros, meta=None):
+        self.capacity = capacity
+        self.times = alloc(2 * capacity, dtype=np.float64)
+        self.values = alloc(2 * capacity, dtype=dtype)
+        self.labels = labels
+        self.integer = integer
+        self.meta = meta
+        self.head = 0
+        self.count = 0
+
+    def __len__(self):
+        return self.count
+
+    def append(self, timestamp, value):
+        i = self.head
+        j = i + self.capacity
+        self.times[i] = self.times[j] = timestamp
+        self.values[i] = self.values[j] = value
+
+        self.head = i + 1 if i + 1 < self.capacity else 0
+        if self.count < self.capacity:
+            self.count += 1
+
+        if self.meta is not None:
+            self.meta[:] = self.head, self.count
+
+    def clear(self):
+        self.head = 0
+        self.count = 0
+        if self.meta is not None:
+            self.meta[:] = 0
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += self.count
+        if not 0 <= index < self.count:
+            raise IndexError('TimeSeries index out of range')
+
+        k = self.head + self.capacity - self.count + index
+
+        return self.times[k].item(), formatvalue(self.values[k].item(), self.labels, self.integer)
+
+    @property
+    def lasttime(self):
+        """Timestamp of the newest sample, None when empty"""
+        if not self.count:
+            return None
+
+        return self.times[self.head + self.capacity - 1].item()
+
+    def last(self, n=None):
+        """Views of the newest n samples (all if None) as contiguous (times, values) arrays"""
+        if n is None or n > self.count:
+            n = self.count
+
+        end = self.head + self.capacity
+
+        return self.times[end - n:end], self.values[end - n:end]
+
+    def lastseconds(self, seconds):
+        """Views of the samples within seconds of the newest one"""
+        times, values = self.last()
+        if not len(times):
+            return times, values
+
+        start = np.searchsorted(times, times[-1] - seconds)
+
+        return times[start:], values[start:]
+
+
+class BucketSeries(object):
+    """Ring buffer of fixed period min/max/mean buckets, filled incrementally
+
+    Samples accumulate into the open bucket and are written out when a sample lands in a
+    later period, so spikes survive as the bucket min/max however coarse the period.
+    Bucket times are the period start. Same doubled-array layout, alloc and meta as TimeSeries.
+    """
+
+    def __init__(self, period, capacity, dtype=np.float32, alloc=np.zeros, meta=None):
+        self.period = period
+        self.capacity = capacity
+        self.times = alloc(2 * capacity, dtype=np.float64)
+        self.mins = alloc(2 * capacity, dtype=dtype)
+        self.maxs = alloc(2 * capacity, dtype=dtype)
+        self.means = alloc(2 * capacity, dtype=dtype)
+        self.meta = meta
+        self.head = 0
+        self.count = 0
+
+        self._index = None
+        self._min = self._max = self._sum = 0.0
+        self._n = 0
+
+    def __len__(self):
+        return self.count
+
+    def add(self, timestamp, value):
+        index = int(timestamp // self.period)
+        if index == self._index:
+            self._n += 1
+            self._sum += value
+            if value < self._min:
+                self._min = value
+            elif value > self._max:
+                self._max = value
+            return
+
+        if self._n:
+            self._flush()
+
+        self._index = index
+        self._min = self._max = self._sum = value
+        self._n = 1
+
+    def _flush(self):
+        i = self.head
+        j = i + self.capacity
+        self.times[i] = self.times[j] = self._index * self.period
+        self.mins[i] = self.mins[j] = self._min
+        self.maxs[i] = self.maxs[j] = self._max
+        self.means[i] = self.means[j] = self._sum / self._n
+
+        self.head = i + 1 if i + 1 < self.capacity else 0
+        if self.count < self.capacity:
+            self.count += 1
+
+        if self.meta is not None:
+            self.meta[:] = self.head, self.count
+
+    def clear(self):
+        self.head = 0
+        self.count = 0
+        self._index = None
+        self._n = 0
+        if self.meta is not None:
+            self.meta[:] = 0
+
+    def last(self, n=None):
+        """Views of the newest n closed buckets as (times, mins, maxs, means)"""
+        if n is None or n > self.count:
+            n = self.count
+
+        end = self.head + self.capacity
+        window = slice(end - n, end)
+
+        return self.times[window], self.mins[window], self.maxs[window], self.means[window]
+
+    def lastseconds(self, seconds, now):
+        """Views of the buckets starting within seconds of now (all if seconds is None)"""
+        times, mins, maxs, means = self.last()
+        start = 0 if seconds is None else np.searchsorted(times, now - seconds)
+
+        return times[start:], mins[start:], maxs[start:], means[start:]
+
+
+HistoryTier = namedtuple('HistoryTier', ['period', 'span', 'capacity'])
+
+# Full rate for ~10s, then 100ms buckets for 2 minutes, 1s for 30 minutes and 10s for the drive (12h).
+HISTORYTIERS = [HistoryTier(period=None, span=10, capacity=1000),
+                HistoryTier(period=0.1, span=120, capacity=1200),
+                HistoryTier(period=1, span=1800, capacity=1800),
+                HistoryTier(period=10, span=None, capacity=4320)]
+
+
+class TieredHistory(object):
+    """Multi-resolution history of one signal
+
+    The first tier keeps raw samples (a TimeSeries), the others BucketSeries of
+    decreasing resolution, all updated on append(). window() picks the finest tier
+    covering the requested span.
+    alloc - array allocator passed to every tier
+    meta - optional int64[len(tiers), 2] array, one (head, count) row per tier
+    """
+
+    def __init__(self, tiers=HISTORYTIERS, dtype=np.float32, alloc=np.zeros, meta=None):
+        self.tiers = tiers
+        self.raw = TimeSeries(tiers[0].capacity, dtype=dtype, alloc=alloc,
+                              meta=meta[0] if meta is not None else None)
+        self.buckets = [BucketSeries(tier.period, tier.capacity, dtype=dtype, alloc=alloc,
+                                     meta=meta[i] if meta is not None else None)
+                        for i, tier in enumerate(tiers) if i]
+
+    def __len__(self):
+        return len(self.raw)
+
+    @property
+    def lasttime(self):
+        return self.raw.lasttime
+
+    def append(self, timestamp, value):
+        self.raw.append(timestamp, value)
+        for bucket in self.buckets:
+            bucket.add(timestamp, value)
+
+    def clear(self):
+        self.raw.clear()
+        for bucket in self.buckets:
+            bucket.clear()
+
+    def window(self, seconds=None, maxpoints=1000):
+        """(times, mins, maxs, means) for the last seconds of history (whole history if None)
+
+        Raw samples come back with mins == maxs == means. Tiers holding more than
+        maxpoints points in the window are merged down to at most maxpoints buckets,
+        keeping the min of mins and max of maxs, so render cost stays bounded.
+        """
+        now = self.raw.lasttime
+        if now is None:
+            empty = np.zeros(0)
+            return empty, empty, empty, empty
+
+        for tier, series in zip(self.tiers, [self.raw] + self.buckets):
+            if tier.span is not None and (seconds is None or seconds > tier.span):
+                continue
+
+            if series is self.raw:
+                times, values = self.raw.lastseconds(seconds)
+                points = (times, values, values, values)
+            else:
+                points = series.lastseconds(seconds, now)
+
+            return self._limit(points, maxpoints)
+
+    @staticmethod
+    def _limit(points, maxpoints):
+        times, mins, maxs, means = points
+        if len(times) <= maxpoints:
+            return points
+
+        group = -(-len(times) // maxpoints)
+        trim = len(times) % group
+        shape = (-1, group)
+
+        return (times[trim:].reshape(shape)[:, 0],
+                mins[trim:].reshape(shape).min(axis=1),
+                maxs[trim:].reshape(shape).max(axis=1),
+                means[trim:].reshape(shape).mean(axis=1))